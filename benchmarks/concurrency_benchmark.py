@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Read latency while the tracker writes. Reader threads request /activity while a writer process, like
+the tracker, saves trips for every station (save_trips, --hours hours per commit) over and over. Runs
+first with plain create_engine connections (rollback journal, a new connection for every session) and
+then with make_engine (WAL, pooled read-only connections for the API and a single writer connection).
+
+    python benchmarks/concurrency_benchmark.py [--stations 200] [--years 1] [--readers 4] [--seconds 20] [--hours 168]
+"""
+
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bikeraccoonAPI import app
+from bikeraccoonAPI.bikeraccoon_api import db
+from bikeraccoonAPI.models import System
+from bikeraccoonAPI.db_functions import save_trips
+from bikeraccoonAPI.engine_functions import make_engine
+from synthetic import make_database, station_ids_for, START
+
+
+def plain_engine(sa_url, engine_opts):
+    # How the API and tracker connected before make_engine
+    return create_engine(sa_url, **engine_opts)
+
+def reader(client, urls, stop, latencies, errors):
+    i = 0
+    while not stop.is_set():
+        t = time.perf_counter()
+        r = client.get(urls[i % len(urls)])
+        if r.status_code == 200:
+            latencies.append(time.perf_counter() - t)
+        else:
+            errors.append(r.status_code)
+        i += 1
+
+def writer(url, mode, station_ids, start, hours, pause, stop, results):
+    engine = create_engine(url) if mode == 'plain' else make_engine(url)
+    session = Session(engine)
+    system = session.query(System).filter(System.name=='bench0').first()
+    rng = np.random.default_rng(0)
+    times = pd.date_range(start, periods=hours, freq='h', tz='UTC')
+    n = len(station_ids) * hours
+    latencies, errors = [], []
+    while not stop.is_set():
+        thdf = pd.DataFrame({'station_id':np.tile(station_ids, hours), 'datetime':np.repeat(times, len(station_ids)),
+                             'trips':rng.poisson(2, n), 'returns':rng.poisson(2, n),
+                             'num_bikes_available':rng.integers(0, 20, n), 'num_docks_available':rng.integers(0, 20, n)})
+        t = time.perf_counter()
+        try:
+            save_trips(system, session, thdf)
+            latencies.append(time.perf_counter() - t)
+        except Exception as e:
+            session.rollback()
+            errors.append(str(e).splitlines()[0])
+        times = times + pd.Timedelta(hours=hours)
+        time.sleep(pause)
+    session.close()
+    results.put((latencies, errors))
+
+def run(path, mode, station_ids, years, n_readers, seconds, hours, pause):
+    if mode == 'plain':
+        db.create_engine = plain_engine
+    else:
+        db.create_engine = lambda sa_url, engine_opts: make_engine(sa_url, readonly=True, **engine_opts)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'  # a new uri makes flask_sqlalchemy a new engine
+    app.config['ACTIVITY_CACHE_ENTRIES'] = 0
+
+    end = START + dt.timedelta(days=365*years) - dt.timedelta(hours=1)
+    urls = [f"/activity?system=bench0&start={end - dt.timedelta(days=7):%Y%m%d%H}&end={end:%Y%m%d%H}&frequency=h",
+            f"/activity?system=bench0&start={end - dt.timedelta(days=30):%Y%m%d%H}&end={end:%Y%m%d%H}&frequency=d&station=all",
+            f"/activity?system=bench0&start={end - dt.timedelta(days=2):%Y%m%d%H}&end={end:%Y%m%d%H}&frequency=h&station=0001"]
+
+    results = multiprocessing.Queue()
+    stop_writer = multiprocessing.Event()
+    process = multiprocessing.Process(target=writer, args=(f'sqlite:///{path}', mode, station_ids, end + dt.timedelta(hours=1),
+                                                           hours, pause, stop_writer, results))
+    process.start()
+
+    stop = threading.Event()
+    reads, read_errors = [], []
+    threads = [threading.Thread(target=reader, args=(app.test_client(), urls, stop, reads, read_errors))
+               for _ in range(n_readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    stop_writer.set()
+    for t in threads:
+        t.join()
+    writes, write_errors = results.get()
+    process.join()
+
+    return reads, read_errors, writes, write_errors
+
+def ms(x, q):
+    return np.percentile(x, q) * 1000 if len(x) > 0 else float('nan')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Read latency during writes, before and after make_engine')
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--hours", type=int, default=168, help="hours of trips saved in each commit")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds between writes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'base.db')
+        print(f"creating {args.stations} stations, {args.years} years", flush=True)
+        make_database(base, n_systems=1, n_stations=args.stations, years=args.years)
+        station_ids = station_ids_for(args.stations) + ['free_bikes']
+
+        print(f"\n{'engine':<8} {'reads':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}"
+              f" {'writes':>7} {'write p50':>10} {'errors':>7}")
+        for mode in ['plain', 'shared']:
+            path = os.path.join(tmp, f'{mode}.db')
+            shutil.copy(base, path)
+            reads, read_errors, writes, write_errors = run(path, mode, station_ids, args.years, args.readers,
+                                                           args.seconds, args.hours, args.pause)
+            print(f"{mode:<8} {len(reads):>7} {ms(reads, 50):>8.1f} {ms(reads, 95):>8.1f} {ms(reads, 99):>8.1f}"
+                  f" {ms(reads, 100):>8.1f} {len(read_errors):>7} {len(writes):>7} {ms(writes, 50):>10.1f}"
+                  f" {len(write_errors):>7}", flush=True)
+            for e in sorted(set(write_errors)):
+                print(f"    writer: {e}")
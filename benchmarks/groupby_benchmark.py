@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the columnar station groupby used by the /activity trip functions
+against the dict-based _dict_groupby it replaced.
+
+    python benchmarks/groupby_benchmark.py [--sizes 10000 100000 1000000] [--frequency h]
+"""
+
+import sys
+import os
+import time
+import random
+import itertools
+import argparse
+import datetime as dt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bikeraccoonAPI.api_functions import _group_station_rows, to_local_time, trim_datetime
+
+
+## Previous implementation, kept here for comparison
+
+def _first(x):
+    return x[0]
+
+def _sum(x):
+    return sum(y for y in x if y is not None)
+
+def _mean(x):
+    s = sum(y for y in x if y is not None)
+    l = len(x)
+    if l == 0:
+        return 0
+    return int(s/l)
+
+def _dict_groupby(res, key_fields, agg_key):
+    if 'datetime' in key_fields:
+        for r in res:
+            r['datetime_notz'] = r['datetime'].strftime('%Y-%m-%d %H')
+        key_fields = [x for x in key_fields if x!='datetime']  + ['datetime_notz']
+        agg_key['datetime']=_first
+
+    key = lambda x: [x[field] for field in key_fields]
+    res = sorted(res,key=key)
+    res = [{'key':k,'data':[{y:x[y] for y in x.keys() if y not in key_fields} for x in group]}
+           for k, group in itertools.groupby(res, key=key)]
+
+    def agg(r):
+        return {field:agg_key[field]([y[field] for y in r['data']])  for field in agg_key.keys() if field in r['data'][0].keys()}
+
+    def agg_keys(r):
+        return {field:r['key'][i] for i,field in enumerate(key_fields) if field!='datetime_notz'}
+
+    return [{**agg_keys(r), **agg(r)} for r in res]
+
+def dict_groupby_stations(res, frequency, tz):
+    for r in res:
+        r['datetime'] = to_local_time(r['datetime'],tz)
+        r['datetime'] = trim_datetime(r['datetime'],frequency)
+    agg_key = {'trips':_sum, 'returns':_sum, 'num_bikes_available': _mean, 'num_docks_available':_mean, 'station':_first}
+    return _dict_groupby(res,['datetime','station_id'],agg_key)
+
+
+def make_rows(n, n_stations=600, start=dt.datetime(2021,1,1)):
+    """
+    n hourly measurements for n_stations stations, as Measurement.as_dict() rows
+    and as partial rows for _group_station_rows
+    """
+    random.seed(n)
+    dicts = []
+    rows = []
+    for i in range(n):
+        station = i % n_stations
+        t = start + dt.timedelta(hours=i // n_stations)
+        trips = random.randint(0,10)
+        returns = random.randint(0,10)
+        bikes = None if random.random() < 0.01 else random.randint(0,20)
+        docks = random.randint(0,20)
+        dicts.append({'datetime':t, 'trips':trips, 'returns':returns,
+                      'num_bikes_available':bikes, 'num_docks_available':docks,
+                      'station_id':f"{station:04d}", 'station':f"Station {station}"})
+        epoch = int((t - dt.datetime(1970,1,1)).total_seconds())
+        rows.append((f"{station:04d}", f"Station {station}", station, epoch, trips, returns, bikes or 0, docks, 1))
+    return dicts, rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark station activity groupby')
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument("--frequency", type=str, default='h')
+    parser.add_argument("--tz", type=str, default='America/Vancouver')
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'_dict_groupby (s)':>18} {'columnar (s)':>14} {'speedup':>8}")
+    for n in args.sizes:
+        dicts, rows = make_rows(n)
+
+        t = time.perf_counter()
+        old = dict_groupby_stations(dicts, args.frequency, args.tz)
+        t_old = time.perf_counter() - t
+
+        t = time.perf_counter()
+        new = _group_station_rows(rows, args.frequency, args.tz)
+        t_new = time.perf_counter() - t
+
+        if old != new:
+            raise AssertionError(f"results differ at {n} rows")
+        print(f"{n:>10} {t_old:>18.3f} {t_new:>14.3f} {t_old/t_new:>7.1f}x")
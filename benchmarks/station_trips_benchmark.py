@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the sorted-array make_station_trips against the pivot_table implementation it replaced,
+on synthetic station_status snapshots.
+
+    python benchmarks/station_trips_benchmark.py [--stations 300 1000 3000] [--snapshots 60]
+"""
+
+import sys
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bikeraccoonAPI.db_functions import make_station_trips
+
+
+## Previous implementation, kept here for comparison
+
+def pivot_station_trips(ddf):
+
+    if len(ddf) == 0:
+        return pd.DataFrame()
+
+    pdf = pd.pivot_table(ddf,columns='station_id',index='datetime',values='num_bikes_available')
+    df = pdf.copy()
+    for col in pdf.columns:
+        df[col] = pdf[col] - pdf[col].shift(-1)
+    df = df.fillna(0.0).astype(int)
+
+    df_stack = df.stack(level=0).reset_index()
+    df_stack.columns = ['datetime','station_id','trips']
+
+    df_stack['returns'] = df_stack['trips']
+    df_stack.loc[df_stack['returns']<0,'returns'] = 0
+
+    df_stack.loc[df_stack['trips']>0,'trips'] = 0
+    df_stack['trips'] = -1*df_stack['trips']
+
+    df_stack = df_stack.set_index('datetime').groupby([pd.Grouper(freq='h'),'station_id']).sum().reset_index()
+
+    # Add available bikes and docks
+    num_bikes_xw = ddf.groupby('station_id').max()['num_bikes_available'].to_dict()
+    num_docks_xw = ddf.groupby('station_id').max()['num_docks_available'].to_dict()
+
+    df_stack['num_bikes_available'] = df_stack['station_id'].map(num_bikes_xw)
+    df_stack['num_docks_available'] = df_stack['station_id'].map(num_docks_xw)
+
+    return df_stack
+
+
+def make_snapshots(n_stations, n_snapshots, interval=20, missing=0.02, seed=0):
+    """
+    Raw station_status rows for n_stations stations polled every interval seconds.
+    A fraction of stations is missing from each snapshot or reports a null num_bikes_available.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2021-06-01 07:50', tz='UTC')
+    times = start + pd.to_timedelta(np.arange(n_snapshots) * interval, unit='s')
+
+    n = n_stations * n_snapshots
+    ddf = pd.DataFrame({'datetime':np.repeat(times, n_stations),
+                        'num_bikes_available':rng.integers(0, 20, n).astype(float),
+                        'num_docks_available':rng.integers(0, 20, n),
+                        'is_renting':True,
+                        'station_id':np.tile([f"{i:04d}" for i in range(n_stations)], n_snapshots)})
+    ddf.loc[rng.random(n) < missing, 'num_bikes_available'] = np.nan
+    return ddf[rng.random(n) >= missing].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark make_station_trips')
+    parser.add_argument("--stations", type=int, nargs='+', default=[300, 1000, 3000])
+    parser.add_argument("--snapshots", type=int, default=60)
+    parser.add_argument("--interval", type=int, default=20, help="seconds between snapshots")
+    args = parser.parse_args()
+
+    print(f"{'stations':>10} {'rows':>10} {'pivot (s)':>10} {'sorted (s)':>11} {'speedup':>8}")
+    for n in args.stations:
+        ddf = make_snapshots(n, args.snapshots, args.interval)
+
+        t = time.perf_counter()
+        old = pivot_station_trips(ddf)
+        t_old = time.perf_counter() - t
+
+        t = time.perf_counter()
+        new = make_station_trips(ddf)
+        t_new = time.perf_counter() - t
+
+        pd.testing.assert_frame_equal(old, new)
+        print(f"{n:>10} {len(ddf):>10} {t_old:>10.3f} {t_new:>11.3f} {t_old/t_new:>7.1f}x")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the API and tracker hot paths, run against a synthetic database
+(see synthetic.py). Times /activity at every frequency and station mode, /stations, /systems,
+make_station_trips, make_free_bike_trips and update_trips.
+
+Results are written as JSON so that runs can be compared:
+
+    python benchmarks/suite.py --output baseline.json
+    python benchmarks/suite.py --baseline baseline.json [--output new.json]
+
+The database is created on the first run and reused after that, pass the same --systems,
+--stations and --years to compare runs.
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bikeraccoonAPI.models import System
+from bikeraccoonAPI.db_functions import (make_station_trips, make_free_bike_trips, update_trips,
+                                         make_raw_tables, save_stations_raw, save_free_bikes_raw)
+from synthetic import (make_database, station_ids_for, bike_ids_for, station_status_stream,
+                       free_bike_status_stream, START)
+
+
+RANGES = {'day':dt.timedelta(days=1), 'week':dt.timedelta(days=7), 'month':dt.timedelta(days=31),
+          'year':dt.timedelta(days=365)}
+FREQUENCIES = ['h', 'd', 'm', 'y', 't']
+STATION_MODES = ['system', 'all', 'station', 'free_bikes']
+
+
+def timings(f, repeat, setup=None):
+    """
+    Run f repeat times (after setup, which isn't timed), returns min and median seconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return {'min':min(times), 'median':float(np.median(times))}
+
+
+def api_cases(sys_name, years):
+    """
+    (name, url) of each API request to time
+    """
+    yield 'systems', '/systems'
+    yield 'stations', f'/stations?system={sys_name}'
+
+    for range_name, length in RANGES.items():
+        if length > dt.timedelta(days=365*years):
+            continue
+        start = START + dt.timedelta(days=365*years) - length  # end of the data, where most queries are
+        end = start + length - dt.timedelta(hours=1)
+        base = f"/activity?system={sys_name}&start={start:%Y%m%d%H}&end={end:%Y%m%d%H}"
+
+        for frequency in FREQUENCIES:
+            for mode in STATION_MODES:
+                station = {'system':'', 'all':'&station=all', 'station':'&station=0000',
+                           'free_bikes':'&station=free_bikes'}[mode]
+                yield f"activity {range_name} {frequency} {mode}", f"{base}&frequency={frequency}{station}"
+        yield f"activity {range_name} t all limit", f"{base}&frequency=t&station=all&limit=10"
+
+def run_api(db_path, sys_name, years, repeat, match):
+    from bikeraccoonAPI import app
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.abspath(db_path)}'
+    app.config['ACTIVITY_CACHE_ENTRIES'] = 0  # time the queries, not the cache
+    client = app.test_client()
+
+    results = {}
+    for name, url in api_cases(sys_name, years):
+        if match and match not in name:
+            continue
+        def get():
+            r = client.get(url)
+            assert r.status_code == 200, (url, r.status_code)
+        results[name] = timings(get, repeat)
+        report(name, results[name])
+    return results
+
+
+def run_tracker(db_path, n_stations, n_bikes, n_snapshots, repeat, match):
+    results = {}
+    station_ids = station_ids_for(n_stations)
+    bike_ids = bike_ids_for(n_bikes)
+    ddf = pd.concat(station_status_stream(station_ids, n_snapshots), ignore_index=True)
+    bdf = pd.concat(free_bike_status_stream(bike_ids, n_snapshots), ignore_index=True)
+
+    cases = {'make_station_trips':lambda: make_station_trips(ddf),
+             'make_free_bike_trips':lambda: make_free_bike_trips(bdf)}
+    for name, f in cases.items():
+        if match and match not in name:
+            continue
+        results[name] = timings(f, repeat)
+        report(name, results[name])
+
+    if match and match not in 'update_trips':
+        return results
+
+    # update_trips writes to the db, so run it on a copy
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        shutil.copy(db_path, path)
+        session = Session(create_engine(f'sqlite:///{path}'))
+        system = session.query(System).first()
+        engine_raw = create_engine(f'sqlite:///{os.path.join(tmp, "raw.db")}')
+        make_raw_tables(system, engine_raw)
+
+        # An hour of polls after the end of the data, so trips are new rows
+        polls = 3600 // 20
+        start = session.execute("select max(datetime) from measurement").scalar()
+        start = pd.Timestamp(start) + pd.Timedelta(hours=1)
+        stream = {'i':0}
+        def fill_raw():
+            t = start + pd.Timedelta(hours=stream['i'])
+            stream['i'] += 1
+            for df in station_status_stream(station_ids, polls, start=t):
+                save_stations_raw(system, engine_raw, df)
+            for df in free_bike_status_stream(bike_ids, polls, start=t):
+                save_free_bikes_raw(system, engine_raw, df)
+
+        results['update_trips'] = timings(lambda: update_trips(system, session, engine_raw), repeat, setup=fill_raw)
+        report('update_trips', results['update_trips'])
+        session.close()
+    return results
+
+
+def report(name, result):
+    line = f"{name:<40} {result['median']*1000:>10.1f} ms {result['min']*1000:>10.1f} ms"
+    print(line, flush=True)
+
+def compare(results, baseline, threshold):
+    """
+    Print the change in median time of each benchmark against a baseline run.
+    Returns the names of benchmarks that are more than threshold slower.
+    """
+    print(f"\n{'benchmark':<40} {'baseline':>13} {'this run':>13} {'change':>8}")
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], result['median']
+        change = new / old - 1 if old > 0 else 0
+        flag = ''
+        if change > threshold:
+            flag = '  slower'
+            slower.append(name)
+        elif change < -threshold:
+            flag = '  faster'
+        print(f"{name:<40} {old*1000:>10.1f} ms {new*1000:>10.1f} ms {change:>+7.0%}{flag}")
+    return slower
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark suite on synthetic data')
+    parser.add_argument("--db", type=str, default='bench.db', help="synthetic db, created if it doesn't exist")
+    parser.add_argument("--systems", type=int, default=2)
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--bikes", type=int, default=2000, help="free bikes in the tracker benchmarks")
+    parser.add_argument("--snapshots", type=int, default=180, help="polls in the tracker benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--match", type=str, default=None, help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", type=str, default=None, help="save results to this json file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare with the results in this json file")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as slower/faster")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"creating {args.db}: {args.systems} systems, {args.stations} stations, {args.years} years", flush=True)
+        make_database(args.db, args.systems, args.stations, args.years)
+
+    print(f"{'benchmark':<40} {'median':>13} {'min':>13}")
+    results = run_api(args.db, 'bench0', args.years, args.repeat, args.match)
+    results.update(run_tracker(args.db, args.stations, args.bikes, args.snapshots, args.repeat, args.match))
+
+    if args.output:
+        run = {'meta':{'date':dt.datetime.now().isoformat(timespec='seconds'), 'revision':git_revision(),
+                       'python':platform.python_version(), 'systems':args.systems, 'stations':args.stations,
+                       'years':args.years, 'bikes':args.bikes, 'snapshots':args.snapshots, 'repeat':args.repeat},
+               'results':results}
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline['results'], args.threshold)
+        if len(slower) > 0:
+            sys.exit(1)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Synthetic data for the benchmarks: a database with years of hourly measurements (and their rollups)
+for any number of systems and stations, and fake GBFS snapshot streams.
+
+    python benchmarks/synthetic.py bench.db [--systems 2] [--stations 100] [--years 2]
+"""
+
+import sys
+import os
+import time
+import argparse
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from bikeraccoonAPI.models import Base, System, Station, Measurement
+from bikeraccoonAPI.db_functions import rebuild_rollups
+
+
+TIMEZONES = ['America/Vancouver', 'America/Toronto', 'Europe/London', 'Asia/Kolkata', 'America/St_Johns']
+START = dt.datetime(2019, 1, 1)
+
+
+def make_database(path, n_systems=2, n_stations=100, years=2, start=START, free_bikes=True, seed=0):
+    """
+    Create a bikeraccoon db at path with n_systems systems named bench0, bench1, ... of n_stations
+    stations each (plus a free_bikes station), hourly measurements from start for the given number
+    of years and their rollups. Systems cycle through TIMEZONES.
+    """
+    rng = np.random.default_rng(seed)
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+
+    hours = np.arange(np.datetime64(start, 'h'), np.datetime64(start.replace(year=start.year + years), 'h'))
+    # Busier during the day, peaking in the afternoon
+    activity = 1 + np.sin((hours.astype(np.int64) % 24 - 9) / 24 * 2 * np.pi)
+
+    for i in range(n_systems):
+        system = System(name=f'bench{i}', tz=TIMEZONES[i % len(TIMEZONES)], url=f'http://localhost/bench{i}/gbfs.json',
+                        is_tracking=True, brand='bench', city=f'City {i}', province='', country='')
+        session.add(system)
+        session.commit()
+
+        station_ids = station_ids_for(n_stations) + (['free_bikes'] if free_bikes else [])
+        stations = [Station(station_id=x, name=f'bench{i} {x}', lat=49.25 + rng.normal(0, 0.02), lon=-123.1 + rng.normal(0, 0.03),
+                            active=True, system_id=system.id, created_date=start)
+                    for x in station_ids]
+        session.add_all(stations)
+        session.commit()
+
+        pks = np.array([x.id for x in stations])
+        size = (len(hours), len(pks))
+        lam = activity[:, None] * rng.uniform(0.5, 4, len(pks))[None, :]
+        mdf = pd.DataFrame({'datetime':np.repeat(hours.astype('datetime64[ns]'), len(pks)),
+                            'station_id':np.tile(pks, len(hours)),
+                            'trips':rng.poisson(lam, size).ravel(),
+                            'returns':rng.poisson(lam, size).ravel(),
+                            'num_bikes_available':rng.integers(0, 20, size).ravel(),
+                            'num_docks_available':rng.integers(0, 20, size).ravel()})
+        mdf.to_sql('measurement', engine, if_exists='append', index=False, chunksize=100000)
+
+        rebuild_rollups(system, session)
+
+    session.execute("analyze")  # planner statistics, as br-manager.py --migrate leaves them
+    session.commit()
+    session.close()
+    return engine
+
+def station_ids_for(n_stations):
+    return [f"{i:04d}" for i in range(n_stations)]
+
+def bike_ids_for(n_bikes):
+    return [f"bike-{i:06d}" for i in range(n_bikes)]
+
+
+def station_status_stream(station_ids, n_snapshots, interval=20, start=START, capacity=20, seed=0):
+    """
+    Successive station_status snapshots, as returned by query_station_status. Each poll a few
+    stations gain or lose bikes.
+    """
+    rng = np.random.default_rng(seed)
+    station_ids = np.array(station_ids, dtype=object)
+    bikes = rng.integers(0, capacity, len(station_ids))
+    t = pd.Timestamp(start, tz='UTC')
+
+    for i in range(n_snapshots):
+        change = rng.integers(-1, 2, len(station_ids)) * (rng.random(len(station_ids)) < 0.1)
+        bikes = np.clip(bikes + change, 0, capacity)
+        yield pd.DataFrame({'datetime':t + pd.Timedelta(seconds=i*interval),
+                            'num_bikes_available':bikes, 'num_docks_available':capacity - bikes,
+                            'is_renting':True, 'station_id':station_ids})
+
+def free_bike_status_stream(bike_ids, n_snapshots, interval=20, start=START, riding=0.05, seed=0):
+    """
+    Successive free_bike_status snapshots, as returned by query_free_bikes. Bikes out on a trip are
+    missing from the feed and show up somewhere else.
+    """
+    rng = np.random.default_rng(seed)
+    bike_ids = np.array(bike_ids, dtype=object)
+    lat = 49.25 + rng.normal(0, 0.02, len(bike_ids))
+    lon = -123.1 + rng.normal(0, 0.03, len(bike_ids))
+    t = pd.Timestamp(start, tz='UTC')
+
+    for i in range(n_snapshots):
+        present = rng.random(len(bike_ids)) >= riding
+        lat = lat + rng.normal(0, 0.0005, len(bike_ids)) * ~present
+        lon = lon + rng.normal(0, 0.0005, len(bike_ids)) * ~present
+        yield pd.DataFrame({'bike_id':bike_ids[present], 'lat':lat[present], 'lon':lon[present],
+                            'datetime':t + pd.Timedelta(seconds=i*interval)})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Create a synthetic bikeraccoon database')
+    parser.add_argument("path", type=str)
+    parser.add_argument("--systems", type=int, default=2)
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--years", type=int, default=2)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        raise SystemExit(f"{args.path} already exists")
+    t = time.perf_counter()
+    make_database(args.path, args.systems, args.stations, args.years)
+    print(f"created {args.path} in {time.perf_counter() - t:.1f}s")
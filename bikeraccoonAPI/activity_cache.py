@@ -0,0 +1,132 @@
+import sqlite3
+import threading
+import datetime as dt
+from collections import OrderedDict, namedtuple
+
+
+# system, t1 and t2 (naive UTC, inclusive) describe the measurements a response was built from.
+# update_id is the latest MeasurementUpdate id when it was built.
+CacheEntry = namedtuple('CacheEntry', ['system','t1','t2','update_id','mimetype','data'])
+
+
+class ActivityCache:
+    """
+    LRU cache of /activity responses, bounded by number of entries and by total response size.
+    If path is given, entries are also kept in a sqlite file so they survive restarts and
+    can be shared between API workers. The file has the same bounds, the oldest entries put
+    there are evicted first.
+
+    Entries aren't invalidated here. get() takes an is_valid callback that checks whether
+    the tracker has written measurements overlapping the entry since it was built, so entries
+    for time ranges in the past stay valid indefinitely.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=256*2**20, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("""create table if not exists activity_cache
+                               (key text primary key, system text, t1 timestamp, t2 timestamp,
+                                update_id integer, mimetype text, data blob)""")
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, is_valid):
+        key = repr(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            entry = self._disk_get(key)
+
+        if entry is not None and not is_valid(entry):
+            self._remove(key)
+            with self.lock:
+                self.invalidations += 1
+            entry = None
+
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        self._memory_put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        key = repr(key)
+        self._memory_put(key, entry)
+
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("insert or replace into activity_cache values (?,?,?,?,?,?,?)", (key,) + tuple(entry))
+                self._disk_evict()
+                self.db.commit()
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                'invalidations':self.invalidations, 'entries':len(self.entries), 'bytes':self.nbytes}
+
+    def _memory_put(self, key, entry):
+        size = len(entry.data)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= len(self.entries.pop(key).data)
+            self.entries[key] = entry
+            self.nbytes += size
+
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted.data)
+                self.evictions += 1
+
+    def _disk_get(self, key):
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute("""select system, t1, t2, update_id, mimetype, data
+                                     from activity_cache where key=?""", (key,)).fetchone()
+        if row is None:
+            return None
+        system, t1, t2, update_id, mimetype, data = row
+        return CacheEntry(system, dt.datetime.fromisoformat(t1), dt.datetime.fromisoformat(t2), update_id, mimetype, data)
+
+    def _disk_evict(self):
+        # The file can be shared, so its size is read from it rather than kept here. Replacing an entry
+        # gives it a new rowid, so rowids are in the order entries were put.
+        n, nbytes = 0, 0
+        for rowid, size in self.db.execute("select rowid, length(data) from activity_cache order by rowid desc"):
+            n += 1
+            nbytes += size
+            if n > self.max_entries or nbytes > self.max_bytes:
+                self.db.execute("delete from activity_cache where rowid <= ?", (rowid,))
+                return
+
+    def _remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= len(entry.data)
+            if self.db is not None:
+                self.db.execute("delete from activity_cache where key=?", (key,))
+                self.db.commit()
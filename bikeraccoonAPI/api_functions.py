@@ -1,138 +1,613 @@
-from flask import Flask, request, make_response, send_from_directory
+from flask import Flask, Response, request, make_response, send_from_directory, has_request_context
 
 import json
+import zlib
+import base64
 import hashlib
 import sqlite3
 import pytz
 import datetime as dt
 import itertools
 import os
-
-from sqlalchemy import create_engine, func
+from urllib.parse import urlencode
+import numpy as np
+import pandas as pd
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from sqlalchemy import create_engine, func, case, cast, Integer, union_all
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import OperationalError
 
-from .models import System, Station, Measurement
+from .models import System, Station, Measurement, StationRollup, SystemRollup, MeasurementUpdate, MEASUREMENT_UPDATES_KEPT
+from .archive_functions import archived_months, read_archives
+from .tz_functions import PERIOD_UNITS, get_tz, to_local_times, utc_offsets, local_periods, trim_datetimes
 from .api_functions import *
 
 
+STATION_FIELDS = ['trips','returns','num_bikes_available','num_docks_available','station','station_id','datetime']
+ALL_STATIONS_FIELDS = ['station_id','trips','returns','num_bikes_available','num_docks_available','station','datetime']
+
 def get_station_trips(session, t1,t2,sys_name,station_id,frequency,tz):
-    qry = session.query(Measurement)
-    qry = qry.filter(Measurement.datetime >= t1, Measurement.datetime <= t2)
-    qry = qry.filter(System.name == sys_name)
-    qry = qry.join(Station).join(System)
-    qry = qry.filter(Station.station_id==station_id)
-    res = [x.as_dict() for x in qry.all()]
+    pieces = split_range(t1, range_end(t2), frequency, tz)
+    rows = _station_rows(session, pieces, sys_name, frequency, tz, station_id)
+    columns, periods = _group_station_columns(rows, frequency, tz)
     
-    # for special case, set all times to initial time
-    if frequency == 't':
-        t = to_local_time(res[0]['datetime'],tz)
-        for r in res:
-            r['datetime'] = t
-    else:
-        for r in res:
-            r['datetime'] = to_local_time(r['datetime'],tz)
-            r['datetime'] = trim_datetime(r['datetime'],frequency)
-        
-    key_fields = ['datetime']
+    if response_format() in COLUMN_FORMATS:
+        return columns_response(columns, periods, tz, STATION_FIELDS)
+    return json_response(_as_rows(columns, periods, STATION_FIELDS))   
 
-    agg_key = {'trips':_sum, 'returns':_sum, 'num_bikes_available': _mean, 'num_docks_available':_mean,
-              'station':_first, 'station_id':_first}
-    res = _dict_groupby(res,key_fields,agg_key)
-    return json_response(res)   
-
-def get_all_stations_trips(session, t1,t2,sys_name,frequency,tz,limit):
-    qry = session.query(Measurement)
-    qry = qry.filter(Measurement.datetime >= t1, Measurement.datetime <= t2)
-    qry = qry.filter(System.name == sys_name)
-    qry = qry.join(Station).join(System)
-    qry = qry.filter(Station.station_id!='free_bikes')
-    res = [x.as_dict() for x in qry.all()]
-
-    # for special case, set all times to initial time
+def get_all_stations_trips(session, t1,t2,sys_name,frequency,tz,limit,rank='trips'):
+    pieces = split_range(t1, range_end(t2), frequency, tz)
+    
+    if frequency == 't' and limit:
+        columns, periods = _top_station_columns(session, pieces, sys_name, tz, limit, rank)
+    else:
+        rows = _station_rows(session, pieces, sys_name, frequency, tz)
+        columns, periods = _group_station_columns(rows, frequency, tz)
+        if frequency == 't' and limit is not None:
+            order = np.argsort(-_rank_values(columns, rank), kind='stable')
+            columns, periods = _take(columns, periods, order)
+    
+    if response_format() in COLUMN_FORMATS:
+        return columns_response(columns, periods, tz, ALL_STATIONS_FIELDS)
+    return json_response(_as_rows(columns, periods, ALL_STATIONS_FIELDS))    
+    
+def get_top_stations(session, systems, t1, t2, limit, rank='trips'):
+    """
+    Top (limit > 0) or bottom (limit < 0) stations of several systems over a time range, as
+    with frequency='t' and station='all'. systems is a list of (name, tz) and t1, t2 are naive
+    local datetimes. Returns {system name: rows}
+    """
+    res = {}
+    for sys_name, tz in systems:
+        pieces = split_range(to_utc(t1,tz), range_end(to_utc(t2,tz)), 't', tz)
+        columns, periods = _top_station_columns(session, pieces, sys_name, tz, limit, rank)
+        res[sys_name] = _as_rows(columns, periods, ALL_STATIONS_FIELDS)
+    return json_response(res)
+    
+    
+def get_system_trips(session, t1,t2, sys_name, frequency,tz):
+    pieces = split_range(t1, range_end(t2), frequency, tz)
+    rows = _system_rows(session, pieces, sys_name, frequency, tz)
+    columns, periods = _group_system_columns(rows, frequency, tz)
+    
+    fields = ['datetime'] + list(columns)
+    if response_format() in COLUMN_FORMATS:
+        return columns_response(columns, periods, tz, fields)
+    return  json_response(_as_rows(columns, periods, fields))
+
+
+## Keyset pagination of station=all, ordered by (local period, station_id)
+
+def get_all_stations_page(session, t1,t2,sys_name,frequency,tz,page_size,token=None):
+    """
+    One page of get_all_stations_trips, ordered by local period and then station_id. token is the
+    next token of the previous page. Rows are read from the DB a window of about page_size groups
+    at a time, so memory per request doesn't depend on the length of the time range.
+    The response carries a Link header to the next page unless this is the last one.
+    """
+    after = decode_page_token(token) if token is not None else None
+    if token is not None and after is None:
+        return make_response(return_api_error())
+    
+    end = range_end(t2)
     if frequency == 't':
-        t = to_local_time(res[0]['datetime'],tz)
-        for r in res:
-            r['datetime'] = t
+        pieces, next_after = _stations_total_page(session, t1, end, sys_name, tz, page_size, after)
     else:
-        for r in res:
-            r['datetime'] = to_local_time(r['datetime'],tz)
-            r['datetime'] = trim_datetime(r['datetime'],frequency)    
+        pieces, next_after = _stations_period_page(session, t1, end, sys_name, frequency, tz, page_size, after)
+    columns, periods = _concat(pieces)
     
-    key_fields = ['datetime','station_id']
+    if response_format() in COLUMN_FORMATS:
+        r = columns_response(columns, periods, tz, ALL_STATIONS_FIELDS)
+    else:
+        r = json_response(_as_rows(columns, periods, ALL_STATIONS_FIELDS))
+    if next_after is not None and r.status_code == 200:
+        _add_next_link(r, encode_page_token(*next_after))
+    return r
 
-    agg_key = {'trips':_sum, 'returns':_sum, 'num_bikes_available': _mean, 'num_docks_available':_mean, 'station':_first}
-    res = _dict_groupby(res,key_fields,agg_key)
+def _stations_period_page(session, t1, end, sys_name, frequency, tz, page_size, after):
+    n_stations = session.query(func.count(func.distinct(Station.station_id))).join(System) \
+                        .filter(System.name == sys_name, Station.station_id != 'free_bikes').scalar()
+    periods_per_window = page_size // max(n_stations, 1) + 1
     
-    if frequency == 't' and limit is not None:
-        res = sorted(res,key=lambda x: x['trips'],reverse=True)
-        if limit > 0:
-            res = res[:limit]
-        elif limit < 0:
-            res = res[limit:]
+    # Windows start and end on local period boundaries so no period is split between them
+    start = t1 if after is None else max(t1, _period_start_utc(after[0], frequency, tz))
+    pieces = []
+    n = 0
+    while n < page_size and start < end:
+        window_end = min(end, _window_end(start, periods_per_window, frequency, tz))
+        rows = _station_rows(session, split_range(start, window_end, frequency, tz), sys_name, frequency, tz)
+        columns, periods = _group_station_columns(rows, frequency, tz)
+        
+        order = _page_order(columns, local_periods(periods[0], frequency), after)[:page_size - n]
+        pieces.append(_take(columns, periods, order))
+        n += len(order)
+        if len(order) > 0:
+            after = (local_periods(periods[0][order[-1:]], frequency)[0], columns['station_id'][order[-1]])
+        start = window_end
+        
+    return pieces, (after if n == page_size else None)
+
+def _stations_total_page(session, t1, end, sys_name, tz, page_size, after):
+    # One period, so the page is the next page_size station ids
+    qry = session.query(Station.station_id).join(System).filter(System.name == sys_name, Station.station_id != 'free_bikes')
+    if after is not None:
+        qry = qry.filter(Station.station_id > after[1])
+    station_ids = [x[0] for x in qry.distinct().order_by(Station.station_id).limit(page_size)]
+    if len(station_ids) == 0:
+        return [], None
     
+    columns, periods = _station_total_columns(session, split_range(t1, end, 't', tz), sys_name, tz, station_ids)
+    order = _page_order(columns, np.zeros(len(periods[0]), dtype=np.int64), None)
     
-    return json_response(res)    
+    return [_take(columns, periods, order)], ((0, station_ids[-1]) if len(station_ids) == page_size else None)
+
+def _station_total_columns(session, pieces, sys_name, tz, station_ids):
+    """
+    frequency 't' columns of a subset of the stations of a system. Every group has the datetime of
+    the earliest row of any station, as when all stations are read.
+    """
+    rows = _station_rows(session, pieces, sys_name, 't', tz, station_ids=station_ids)
+    columns, periods = _group_station_columns(rows, 't', tz)
+    if len(rows) > 0:
+        local, tzinfos = to_local_times(np.array([_first_station_epoch(session, pieces, sys_name)], dtype='datetime64[s]'), tz)
+        periods = (np.repeat(local, len(periods[0])), np.repeat(tzinfos, len(periods[0])))
+    return columns, periods
+
+def _first_station_epoch(session, pieces, sys_name):
+    firsts = []
+    for level, start, end in pieces:
+        if level == 'h':
+            qry = session.query(_epoch(func.min(Measurement.datetime))).select_from(Measurement)
+            qry = qry.filter(Measurement.datetime >= start, Measurement.datetime < end)
+        else:
+            qry = session.query(_epoch(func.min(StationRollup.first_datetime))).select_from(StationRollup)
+            qry = qry.filter(StationRollup.frequency == level)
+            qry = qry.filter(StationRollup.first_datetime >= start, StationRollup.first_datetime < end)
+        qry = qry.join(Station).join(System).filter(System.name == sys_name, Station.station_id != 'free_bikes')
+        firsts.append(qry.scalar())
+        if level == 'h':
+            firsts += [x[3] for x in _archived_station_rows(session, start, end, sys_name, 't')]
+    return min(x for x in firsts if x is not None)
+
+def _page_order(columns, keys, after):
+    """
+    Index of the groups after the (period, station_id) cursor, sorted by period and station_id
+    """
+    station_ids = columns['station_id'].astype(str)
+    order = np.lexsort((station_ids, keys))
+    if after is not None:
+        keep = (keys > after[0]) | ((keys == after[0]) & (station_ids > after[1]))
+        order = order[keep[order]]
+    return order
+
+def _window_end(start, n_periods, frequency, tz):
+    local, _ = to_local_times(np.array([start.replace(tzinfo=None)], dtype='datetime64[us]'), tz)
+    key = int(local_periods(local, frequency)[0]) + n_periods
+    while _period_start_utc(key, frequency, tz) <= start:  # periods inside a skipped hour have no length
+        key += 1
+    return _period_start_utc(key, frequency, tz)
+
+def _period_start_utc(key, frequency, tz):
+    local = np.datetime64(int(key), PERIOD_UNITS[frequency]).astype('datetime64[us]').item()
+    tz = get_tz(tz)
+    try:
+        t = tz.localize(local, is_dst=None)
+    except pytz.AmbiguousTimeError:
+        t = tz.localize(local, is_dst=True)  # a period starting in a repeated hour starts at its first occurrence
+    except pytz.NonExistentTimeError:
+        t = tz.localize(local, is_dst=False)  # and one starting in a skipped hour at the end of the gap
+    return t.astimezone(pytz.utc)
+
+def _concat(pieces):
+    if len(pieces) == 0:
+        return _group_station_columns([], 't', None)
+    columns = {k:np.concatenate([c[k] for c,_ in pieces]) for k in pieces[0][0]}
+    periods = tuple(np.concatenate([p[i] for _,p in pieces]) for i in range(2))
+    return columns, periods
+
+def encode_page_token(period, station_id):
+    return base64.urlsafe_b64encode(json.dumps([int(period), str(station_id)], separators=(',', ':')).encode()).decode()
+
+def decode_page_token(token):
+    try:
+        period, station_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return int(period), str(station_id)
+    except (ValueError, TypeError):
+        return None
+
+def _add_next_link(r, token):
+    if not has_request_context():
+        return
+    args = request.args.to_dict()
+    args['next'] = token
+    r.headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+
+
+ROLLUP_LEVELS = {'h':['h'], 'd':['d','h'], 'm':['m','d','h'], 'y':['y','m','d','h'], 't':['y','m','d','h']}
+
+def _period_floor(t, level):
+    return trim_datetime(t, level).replace(minute=0, second=0, microsecond=0)
+
+def _next_period(t, level):
+    if level == 'd':
+        return t + dt.timedelta(days=1)
+    elif level == 'm':
+        return (t.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+    elif level == 'y':
+        return t.replace(year=t.year+1)
+
+def range_end(t2):
+    """
+    Exclusive end of a range that includes the UTC time t2. Measurements are on whole UTC hours, so this
+    is the hour after t2, which for half-hour UTC offsets is not t2 + 1 hour.
+    """
+    return t2.replace(minute=0, second=0, microsecond=0) + dt.timedelta(hours=1)
+
+def split_range(t1, t2, frequency, tz):
+    """
+    Split the UTC time range [t1, t2) into pieces that can be read from the coarsest
+    rollup table. Returns a list of (level, start, end) tuples, where level 'h' means
+    the hourly measurement table.
+    """
+    return _split_range(t1, t2, ROLLUP_LEVELS.get(frequency, ['h']), tz)
     
+def _split_range(t1, t2, levels, tz):
+    if t1 >= t2:
+        return []
     
+    level = levels[0]
+    if level == 'h':
+        return [('h', t1, t2)]
     
-def get_system_trips(session, t1,t2, sys_name, frequency,tz):
-    # First, query trips from stations
-    qry = session.query(Measurement.datetime,func.sum(Measurement.trips), func.sum(Measurement.returns))
-    qry = qry.filter(Measurement.datetime >= t1, Measurement.datetime <= t2)
-    qry = qry.filter(System.name == sys_name)
-    qry = qry.filter(Station.id != 'free_bikes')
-    qry = qry.join(Station).join(System)
+    # First and last local period boundaries inside the range
+    start = _period_floor(to_local_time(t1,tz).replace(tzinfo=None), level)
+    if to_utc(start,tz) < t1:
+        start = _next_period(start, level)
+    end = _period_floor(to_local_time(t2,tz).replace(tzinfo=None), level)
+    start, end = to_utc(start,tz), to_utc(end,tz)
+    
+    if start >= end:
+        return _split_range(t1, t2, levels[1:], tz)
+    
+    return _split_range(t1, start, levels[1:], tz) + [(level, start, end)] + _split_range(end, t2, levels[1:], tz)
+    
+
+## Station rankings for frequency 't'
 
+RANKS = ['trips', 'returns', 'net']  # net: returns - trips, the bikes a station gained
 
-    qry = qry.group_by(Measurement.datetime)
+def _rank_values(columns, rank):
+    if rank == 'net':
+        return columns['returns'] - columns['trips']
+    return columns[rank]
 
-    res = qry.all()
+def _top_station_columns(session, pieces, sys_name, tz, limit, rank):
+    """
+    The top limit stations by rank, or the bottom -limit stations, ordered as if all stations were
+    sorted by rank descending. Stations are ranked in the DB and only their rows are read.
+    """
+    if len(pieces) == 0:
+        return _group_station_columns([], 't', tz)
     
-    #Special case for freq=t
-    if frequency == 't':
-        res = [{'datetime':to_local_time(res[0][0],tz),'trips':trips,'returns':returns} for time,trips,returns in res]
+    totals = union_all(*[_station_totals(session, level, start, end, sys_name).statement
+                         for level, start, end in pieces]).alias()
+    trips = func.coalesce(func.sum(totals.c.trips), 0)
+    returns = func.coalesce(func.sum(totals.c.returns), 0)
+    value = {'trips':trips, 'returns':returns, 'net':returns - trips}[rank]
+    
+    archived = [x for level, start, end in pieces if level == 'h'
+                for x in _archived_station_rows(session, start, end, sys_name, 't')]
+    if len(archived) == 0:
+        qry = session.query(totals.c.station_id).group_by(totals.c.station_id)
+        if limit > 0:
+            qry = qry.order_by(value.desc(), totals.c.station_id)
+        else:
+            # Ties are in station_id order when sorted descending, so the bottom ones have the last ids
+            qry = qry.order_by(value, totals.c.station_id.desc())
+        station_ids = [x[0] for x in qry.limit(abs(limit))]
     else:
-        res =  [{'datetime':to_local_time(time,tz),'trips':trips,'returns':returns} for time,trips,returns in res]
-        for r in res:
-            r['datetime'] = trim_datetime(r['datetime'],frequency)
-        
-    key_fields = ['datetime']
-    agg_key = {'trips':_sum, 'returns':_sum, 'num_bikes_available': _mean, 'num_docks_available':_mean,
-          'station_id': _first, 'station':_first}
-    res = _dict_groupby(res,key_fields,agg_key)
-    res = [ {'datetime':x['datetime'], 'station trips':x['trips']} for x in res] # Don't need returns for the whole system
-
-    # Then query trips from free bikes
-    qry2 = session.query(Measurement.datetime,func.sum(Measurement.trips), func.sum(Measurement.returns))
-    qry2 = qry2.filter(Measurement.datetime >= t1, Measurement.datetime <= t2)
-    qry2 = qry2.filter(System.name == sys_name)
-    qry2 = qry2.filter(Station.station_id == 'free_bikes')
-    qry2 = qry2.join(Station).join(System)
-
+        # Ranked here, with the archived trips and returns added to each station's totals from the DB
+        qry = session.query(totals.c.station_id, trips, returns).group_by(totals.c.station_id)
+        df = pd.DataFrame(qry.all() + [(x[0], x[4], x[5]) for x in archived], columns=['station_id', 'trips', 'returns'])
+        df = df.fillna(0).groupby('station_id', as_index=False).sum()
+        df['net'] = df['returns'] - df['trips']
+        df = df.sort_values([rank, 'station_id'], ascending=[limit < 0, limit > 0])
+        station_ids = df['station_id'].tolist()[:abs(limit)]
+    if limit < 0:
+        station_ids = station_ids[::-1]
+    
+    if len(station_ids) == 0:
+        return _group_station_columns([], 't', tz)
+    columns, periods = _station_total_columns(session, pieces, sys_name, tz, station_ids)
+    position = {x:i for i,x in enumerate(station_ids)}
+    order = np.argsort([position[x] for x in columns['station_id']])
+    return _take(columns, periods, order)
+
+def _station_totals(session, level, start, end, sys_name):
+    # station_id, trips, returns of every hourly measurement or rollup row in a piece
+    if level == 'h':
+        qry = session.query(Station.station_id.label('station_id'), Measurement.trips.label('trips'),
+                            Measurement.returns.label('returns'))
+        qry = qry.select_from(Measurement).join(Station).join(System)
+        qry = qry.filter(Measurement.datetime >= start, Measurement.datetime < end)
+    else:
+        qry = session.query(Station.station_id.label('station_id'), StationRollup.trips.label('trips'),
+                            StationRollup.returns.label('returns'))
+        qry = qry.select_from(StationRollup).join(Station).join(System)
+        qry = qry.filter(StationRollup.frequency == level)
+        qry = qry.filter(StationRollup.first_datetime >= start, StationRollup.first_datetime < end)
+    return qry.filter(System.name == sys_name, Station.station_id != 'free_bikes')
+    
 
-    qry2 = qry2.group_by(Measurement.datetime)
-    res2 = qry2.all()
+def _station_rows(session, pieces, sys_name, frequency, tz, station_id=None, station_ids=None):
+    """
+    Read partial station rows for each piece of a split time range:
+    (station_id, station, Station.id, UTC epoch seconds, trips, returns, bikes total, docks total, n)
+    Hourly measurements are grouped by station and local time period in the DB.
+    station_ids restricts the rows to a list of stations.
+    """
+    rows = []
+    for level, start, end in pieces:
+        rows += _station_query(session, level, start, end, sys_name, frequency, tz, station_id, station_ids).all()
+        if level == 'h':
+            rows += _archived_station_rows(session, start, end, sys_name, frequency, station_id, station_ids)
+    return rows
+
+def _station_query(session, level, start, end, sys_name, frequency, tz, station_id=None, station_ids=None):
+    if level == 'h':
+        qry = session.query(Station.station_id, Station.name, Station.id, _epoch(func.min(Measurement.datetime)),
+                            func.sum(Measurement.trips), func.sum(Measurement.returns),
+                            func.sum(Measurement.num_bikes_available), func.sum(Measurement.num_docks_available),
+                            func.count(Measurement.id))
+        qry = qry.select_from(Measurement).join(Station).join(System)
+        qry = qry.filter(Measurement.datetime >= start, Measurement.datetime < end)
+        qry = qry.group_by(Station.id)
+        if frequency != 't':
+            qry = qry.group_by(local_period(Measurement.datetime, start, end, frequency, tz))
+    else:
+        qry = session.query(Station.station_id, Station.name, Station.id, _epoch(StationRollup.first_datetime),
+                            StationRollup.trips, StationRollup.returns,
+                            StationRollup.num_bikes_total, StationRollup.num_docks_total,
+                            StationRollup.n_measurements)
+        qry = qry.select_from(StationRollup).join(Station).join(System)
+        qry = qry.filter(StationRollup.frequency == level)
+        qry = qry.filter(StationRollup.first_datetime >= start, StationRollup.first_datetime < end)
+    return _filter_station(qry, sys_name, station_id, station_ids)
+
+def _archived_station_rows(session, start, end, sys_name, frequency, station_id=None, station_ids=None):
+    # Partial station rows of the archived measurements in [start, end): one for each measurement, or
+    # for each station with frequency 't'. Doesn't read anything if no archived month overlaps the range.
+    entries = archived_months(session, sys_name, start, end)
+    if len(entries) == 0:
+        return []
+    
+    qry = _filter_station(session.query(Station.id, Station.station_id, Station.name).join(System), sys_name, station_id, station_ids)
+    stations = pd.DataFrame(qry.all(), columns=['station', 'station_id', 'name'])
+    mdf = read_archives(entries, start, end, stations['station'].tolist()).merge(stations, on='station')
+    mdf['t'] = mdf['datetime'].values.astype('datetime64[s]').astype(np.int64)
+    mdf['n'] = 1
+    if frequency == 't':
+        g = mdf.groupby('station', sort=False)
+        mdf = pd.concat([g[['station_id', 'name']].nth(0), g['t'].min(),
+                         g[['trips', 'returns', 'num_bikes_available', 'num_docks_available', 'n']].sum()], axis=1).reset_index()
+    return list(zip(mdf['station_id'], mdf['name'], mdf['station'], mdf['t'], mdf['trips'], mdf['returns'],
+                    mdf['num_bikes_available'], mdf['num_docks_available'], mdf['n']))
 
-    if len(res2) == 0:
-        return json_response(res)
+def _epoch(column):
+    return cast(func.strftime('%s', column), Integer)
 
+def _filter_station(qry, sys_name, station_id, station_ids=None):
+    qry = qry.filter(System.name == sys_name)
+    if station_id is None:
+        qry = qry.filter(Station.station_id!='free_bikes')
+    else:
+        qry = qry.filter(Station.station_id==station_id)
+    if station_ids is not None:
+        qry = qry.filter(Station.station_id.in_(station_ids))
+    return qry
     
-    res2 =  [{'datetime':to_local_time(time,tz),'trips':trips,'returns':returns} for time,trips,returns in res2]
-    for r in res2:
-        r['datetime'] = trim_datetime(r['datetime'],frequency)
-    res2 = _dict_groupby(res2,key_fields,agg_key)
+def _system_rows(session, pieces, sys_name, frequency, tz):
+    """
+    Read partial system rows for each piece of a split time range:
+    (UTC epoch seconds, trips, free bike trips, free bike measurements)
+    Station trips have always included free bike trips.
+    """
+    rows = []
+    for level, start, end in pieces:
+        qry = _system_query(session, level, start, end, sys_name, frequency, tz)
+        rows += [x for x in qry.all() if x[0] is not None]  # hourly with no group by returns one empty row
+        if level == 'h':
+            rows += _archived_system_rows(session, start, end, sys_name, frequency)
+    return rows
+
+def _system_query(session, level, start, end, sys_name, frequency, tz):
+    is_free_bikes = Station.station_id == 'free_bikes'
     
+    if level == 'h':
+        # Station and free bike totals side by side
+        qry = session.query(_epoch(func.min(Measurement.datetime)), func.sum(Measurement.trips),
+                            func.sum(case([(is_free_bikes, Measurement.trips)], else_=0)),
+                            func.count(case([(is_free_bikes, Measurement.id)])))
+        qry = qry.join(Station).join(System)
+        qry = qry.filter(Measurement.datetime >= start, Measurement.datetime < end)
+        qry = qry.filter(System.name == sys_name)
+        if frequency != 't':
+            qry = qry.group_by(local_period(Measurement.datetime, start, end, frequency, tz))
+    else:
+        qry = session.query(_epoch(SystemRollup.first_datetime), SystemRollup.trips,
+                            SystemRollup.free_bike_trips, SystemRollup.free_bike_measurements)
+        qry = qry.join(System)
+        qry = qry.filter(SystemRollup.frequency == level)
+        qry = qry.filter(SystemRollup.first_datetime >= start, SystemRollup.first_datetime < end)
+        qry = qry.filter(System.name == sys_name)
+    return qry
     
-    # Add free bikes to main response
-    for r in res:
-
-        r['free bike trips'] = [r2 for r2 in res2 if r2['datetime']==r['datetime']]
-        if len(r['free bike trips']) > 0 and 'trips' in r['free bike trips'][0].keys():
-            r['free bike trips'] = r['free bike trips'][0]['trips']
-        else:
-            r['free bike trips'] = 0
-    return  json_response(res)
-
+def _archived_system_rows(session, start, end, sys_name, frequency):
+    # Partial system rows of the archived measurements in [start, end): one for each hour, or for the range with frequency 't'
+    entries = archived_months(session, sys_name, start, end)
+    if len(entries) == 0:
+        return []
+    
+    qry = session.query(Station.id, Station.station_id).join(System).filter(System.name == sys_name)
+    stations = pd.DataFrame(qry.all(), columns=['station', 'station_id'])
+    stations['free_bikes'] = stations['station_id'] == 'free_bikes'
+    mdf = read_archives(entries, start, end).merge(stations, on='station')
+    if len(mdf) == 0:
+        return []
+    
+    mdf['t'] = mdf['datetime'].values.astype('datetime64[s]').astype(np.int64)
+    mdf['fb_trips'] = mdf['trips'].where(mdf['free_bikes'], 0)
+    mdf['fb_n'] = mdf['free_bikes'].astype(int)
+    g = mdf.groupby(mdf['t'] if frequency != 't' else np.zeros(len(mdf)))
+    df = pd.concat([g['t'].min(), g[['trips', 'fb_trips', 'fb_n']].sum()], axis=1)
+    return list(zip(df['t'], df['trips'], df['fb_trips'], df['fb_n']))
+    
+def endpoint_queries(session, system, end=None):
+    """
+    The queries behind /activity for a system, by name: hourly station, all stations and system
+    rows for the week before end (default now) and their daily rollups for the month before it
+    """
+    end = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0) if end is None else end
+    week = end - dt.timedelta(days=7)
+    month = end - dt.timedelta(days=30)
+    qry = session.query(Station.station_id).filter(Station.system_id==system.id, Station.station_id!='free_bikes')
+    station_id = qry.order_by(Station.station_id).limit(1).scalar()
+    
+    queries = {}
+    if station_id is not None:
+        queries[f'station {station_id} h'] = _station_query(session, 'h', week, end, system.name, 'h', system.tz, station_id)
+    queries['stations h'] = _station_query(session, 'h', week, end, system.name, 'h', system.tz)
+    queries['stations t'] = _station_totals(session, 'h', week, end, system.name)
+    queries['system h'] = _system_query(session, 'h', week, end, system.name, 'h', system.tz)
+    queries['stations d'] = _station_query(session, 'd', month, end, system.name, 'd', system.tz)
+    queries['system d'] = _system_query(session, 'd', month, end, system.name, 'd', system.tz)
+    return queries
+
+
+def _as_datetimes(local, tzinfos):
+    return [t.replace(tzinfo=tzinfo) for t, tzinfo in zip(local.astype(object), tzinfos)]
+
+def _column(values, dtype=np.int64):
+    # None -> 0, as sums skip missing values
+    return np.nan_to_num(np.array(values, dtype=float)).astype(dtype)
+
+def _means(totals, n):
+    return np.where(n > 0, totals / np.maximum(n, 1), 0).astype(np.int64)
+
+def _groupby(keys, order_by, sums):
+    """
+    Columnar groupby. Rows are grouped by the integer arrays in keys and ordered
+    within groups by the arrays in order_by. Returns the index of the first row of
+    each group and the per-group totals of each array in sums, with groups sorted by key.
+    """
+    order = np.lexsort(tuple(reversed(keys + order_by)))  # lexsort uses the last array as the primary key
+    
+    same_group = np.ones(len(order) - 1, dtype=bool)
+    for k in keys:
+        k = k[order]
+        same_group &= k[1:] == k[:-1]
+    starts = np.concatenate([[0], np.flatnonzero(~same_group) + 1])
+    
+    return order[starts], [np.add.reduceat(x[order], starts) for x in sums]
+
+def _group_periods(t, local, tzinfos, first, frequency):
+    """
+    Local start of each group's period: the trimmed local time of its first row, or for
+    frequency 't' the local time of the earliest row overall. t, local and tzinfos are the UTC
+    times of the rows and their to_local_times. Returns naive local datetime64 values and the
+    tzinfo of the first row.
+    """
+    if frequency == 't':
+        first = np.full(len(first), np.argmin(t))
+    return trim_datetimes(local[first], frequency), tzinfos[first]
+
+def _group_station_columns(rows, frequency, tz):
+    """
+    Group partial station rows by station_id and local time period. The datetime
+    and station name of each group come from its earliest row.
+    Returns a dict of columns and the local period of each group (see _group_periods).
+    """
+    if len(rows) == 0:
+        return {field:np.array([], dtype=np.int64) for field in ALL_STATIONS_FIELDS if field != 'datetime'}, _no_periods()
+    
+    station_ids, stations, pks, t, trips, returns, bikes, docks, n = zip(*rows)
+    station_ids, station_codes = np.unique(np.array(station_ids, dtype=str), return_inverse=True)
+    t = np.array(t, dtype=np.int64).astype('datetime64[s]')
+    local, tzinfos = to_local_times(t, tz)
+    
+    first, (trips, returns, bikes, docks, n) = _groupby([station_codes, local_periods(local, frequency)],
+                                                        [t, np.array(pks)],
+                                                        [_column(trips), _column(returns), _column(bikes),
+                                                         _column(docks), _column(n)])
+    
+    columns = {'station_id':station_ids[station_codes[first]].astype(object), 'trips':trips, 'returns':returns,
+               'num_bikes_available':_means(bikes, n), 'num_docks_available':_means(docks, n),
+               'station':np.array(stations, dtype=object)[first]}
+    return columns, _group_periods(t, local, tzinfos, first, frequency)
+
+def _group_station_rows(rows, frequency, tz):
+    columns, periods = _group_station_columns(rows, frequency, tz)
+    return _as_rows(columns, periods, ALL_STATIONS_FIELDS)
+        
+def _group_system_columns(rows, frequency, tz):
+    """
+    Group partial system rows by local time period. 'free bike trips' is only included
+    if the system has free bike data in the range.
+    """
+    if len(rows) == 0:
+        return {'station trips':np.array([], dtype=np.int64)}, _no_periods()
+    
+    t, trips, fb_trips, fb_n = zip(*rows)
+    t = np.array(t, dtype=np.int64).astype('datetime64[s]')
+    local, tzinfos = to_local_times(t, tz)
+    
+    first, (trips, fb_trips, fb_n) = _groupby([local_periods(local, frequency)], [t],
+                                              [_column(trips), _column(fb_trips), _column(fb_n)])
+    
+    columns = {'station trips':trips}
+    if fb_n.sum() > 0:
+        columns['free bike trips'] = fb_trips
+    return columns, _group_periods(t, local, tzinfos, first, frequency)
+
+def _no_periods():
+    return np.array([], dtype='datetime64[us]'), np.array([], dtype=object)
+
+def _take(columns, periods, index):
+    return {k:v[index] for k,v in columns.items()}, (periods[0][index], periods[1][index])
+
+def _as_rows(columns, periods, fields):
+    """
+    List of dicts of python values, with datetime as aware datetimes
+    """
+    values = {k:v.tolist() for k,v in columns.items()}
+    values['datetime'] = _as_datetimes(*periods)
+    return [dict(zip(fields, row)) for row in zip(*[values[field] for field in fields])]
+
+def _as_timestamps(periods, tz):
+    """
+    Timezone aware pandas timestamps of the local period starts. Hours that occur twice at the end of DST
+    are resolved with the tzinfo of the period's first row.
+    """
+    local, tzinfos = periods
+    is_dst = {x:bool(x.dst(dt.datetime(2000, 1, 1, tzinfo=x))) for x in set(tzinfos)}  # pytz tzinfos carry their own dst
+    dst = np.array([is_dst[x] for x in tzinfos], dtype=bool)
+    return pd.DatetimeIndex(local).tz_localize(tz, ambiguous=dst, nonexistent='shift_forward')
 
 
 def string_to_datetime(t):
@@ -143,64 +618,227 @@ def string_to_datetime(t):
     return dt.datetime(y,m,d,h)
 
 def to_utc(t,tz):
-    return pytz.timezone(tz).localize(t).astimezone(pytz.utc)
+    return get_tz(tz).localize(t).astimezone(pytz.utc)
 
 def to_local_time(t,tz):
-    return t.replace(tzinfo=pytz.utc).astimezone(pytz.timezone(tz)) 
+    return t.replace(tzinfo=pytz.utc).astimezone(get_tz(tz)) 
+
+BUCKET_FORMATS = {'h':'%Y-%m-%d %H', 'd':'%Y-%m-%d', 'm':'%Y-%m', 'y':'%Y'}
+
+def _offset_modifier(offset):
+    return f"{int(offset.total_seconds()):+d} seconds"
+
+def local_period(column, t1, t2, frequency, tz):
+    """
+    SQL expression giving the local time period (as a string) of a UTC datetime column,
+    valid for values in [t1, t2)
+    """
+    offsets = utc_offsets(t1, t2, tz)
+    modifier = _offset_modifier(offsets[-1][1])
+    if len(offsets) > 1:
+        modifier = case([(column < t, _offset_modifier(offset)) for (t,_),(_,offset) in zip(offsets[1:],offsets[:-1])],
+                        else_=modifier)
+    return func.strftime(BUCKET_FORMATS.get(frequency, BUCKET_FORMATS['h']), column, modifier)
+
+def latest_update_id(session):
+    """
+    Id of the latest MeasurementUpdate, 0 if there are none. None if the DB predates the update log.
+    """
+    try:
+        return session.query(func.max(MeasurementUpdate.id)).scalar() or 0
+    except OperationalError:
+        session.rollback()
+        return None
+
+def updated_since(session, entry):
+    """
+    True if measurements in a cached response's time range have changed since it was built,
+    or if the update log of its system has been trimmed past it
+    """
+    qry = session.query(func.min(MeasurementUpdate.id), func.count(MeasurementUpdate.id)).join(System)
+    oldest, n = qry.filter(System.name == entry.system).one()
+    if n >= MEASUREMENT_UPDATES_KEPT and entry.update_id < oldest:
+        return True
+    
+    qry = session.query(MeasurementUpdate.id).join(System).filter(System.name == entry.system)
+    qry = qry.filter(MeasurementUpdate.id > entry.update_id)
+    qry = qry.filter(MeasurementUpdate.last_datetime >= entry.t1, MeasurementUpdate.first_datetime <= entry.t2)
+    return qry.first() is not None
+
+def cached_response(entry):
+    r = make_response(entry.data)
+    r.mimetype = entry.mimetype
+    return r
 
 def json_response(r):
-    r = make_response(json.dumps(r, default=str, indent=4))
-    r.mimetype = "text/plain"
-    return r
+    """
+    Serialize a list of rows (or any json object) for the current request.
+    JSON is compact unless indent=n is given. format=ndjson writes one row per line.
+    stream=true sends the response in chunks as it's encoded instead of building it in memory.
+    """
+    args = request.args if has_request_context() else {}
+    indent = _int_arg(args, 'indent')
+    fmt = args.get('format', 'json')
+    stream = args.get('stream', 'false').lower() in ('1', 'true', 'yes')
     
-    res.mimetype = "text/plain"
-
-def _first(x):
-
-    return x[0]
-
-def _sum(x):
-    return sum(y for y in x if y is not None)
+    if fmt == 'ndjson':
+        chunks = _ndjson_chunks(r if isinstance(r, list) else [r])
+        mimetype = "application/x-ndjson"
+    elif fmt == 'json' and stream and indent is None and isinstance(r, list):
+        chunks = _json_array_chunks(r)
+        mimetype = "text/plain"
+    elif fmt == 'json':
+        chunks = [dumps(r, indent)]
+        mimetype = "text/plain"
+    else:
+        return make_response(return_api_error())
+    
+    if stream:
+        return Response(chunks, mimetype=mimetype)
+    r = make_response(''.join(chunks))
+    r.mimetype = mimetype
+    return r
 
-def _mean(x):
-    s = sum(y for y in x if y is not None)
-    l = len(x)
-    if l == 0:
-        return 0
-    return int(s/l)
+def dumps(r, indent=None):
+    """
+    json.dumps with datetimes written as str(datetime). Rows often share datetimes, so strings are memoized.
+    """
+    if indent is not None:
+        return json.dumps(r, default=str, indent=indent)
+    return _encoder().encode(r)
+
+def _encoder():
+    memo = {}
+    def default(o):
+        s = memo.get(o)
+        if s is None:
+            s = memo[o] = str(o)
+        return s
+    return json.JSONEncoder(default=default, separators=(',', ':'))
+
+STREAM_CHUNK_ROWS = 1000
+
+def _json_array_chunks(rows):
+    encoder = _encoder()
+    yield '['
+    for i in range(0, len(rows), STREAM_CHUNK_ROWS):
+        chunk = encoder.encode(rows[i:i+STREAM_CHUNK_ROWS])[1:-1]
+        yield chunk if i == 0 else ',' + chunk
+    yield ']'
+
+def _ndjson_chunks(rows):
+    encoder = _encoder()
+    for i in range(0, len(rows), STREAM_CHUNK_ROWS):
+        yield ''.join(encoder.encode(row) + '\n' for row in rows[i:i+STREAM_CHUNK_ROWS])
+
+def _int_arg(args, name):
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return None
     
     
-def _dict_groupby(res, key_fields, agg_key):
-
+## Columnar formats, built from columns rather than rows
+
+COLUMN_FORMATS = {'csv':'text/csv', 'parquet':'application/vnd.apache.parquet',
+                  'arrow':'application/vnd.apache.arrow.file', 'msgpack':'application/x-msgpack'}
+
+def response_format():
+    args = request.args if has_request_context() else {}
+    return args.get('format', 'json')
+
+def columns_response(columns, periods, tz, fields):
+    """
+    Respond with grouped columns in the requested columnar format.
+    The datetime column holds timestamps in the system timezone.
+    """
+    df = pd.DataFrame({field:_as_timestamps(periods, tz) if field == 'datetime' else columns[field]
+                       for field in fields})
+    return frame_response(df)
+
+def frame_response(df):
+    """
+    Serialize a DataFrame as format=csv|parquet|arrow|msgpack. Parquet and Arrow keep timezone aware
+    timestamp types, msgpack is a map of column name to list of values with datetimes as ISO strings.
+    """
+    fmt = response_format()
+    if fmt not in COLUMN_FORMATS:
+        return make_response(return_api_error())
+    if (fmt in ('parquet', 'arrow') and pyarrow is None) or (fmt == 'msgpack' and msgpack is None):
+        return make_response((f"format={fmt} is not available on this server", 501))
     
-    # We need to group datetimes without tz info to avoid a bug during DST changes
-    if 'datetime' in key_fields:
-        for r in res:
-            r['datetime_notz'] = r['datetime'].strftime('%Y-%m-%d %H')
-            
-        key_fields = [x for x in key_fields if x!='datetime']  + ['datetime_notz']
-        agg_key['datetime']=_first
+    if fmt == 'csv':
+        data = df.to_csv(index=False)
+    elif fmt == 'msgpack':
+        data = msgpack.packb({name:_msgpack_values(df[name]) for name in df.columns})
+    else:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        sink = pyarrow.BufferOutputStream()
+        if fmt == 'parquet':
+            pyarrow.parquet.write_table(table, sink)
+        else:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        data = sink.getvalue().to_pybytes()
     
-    key = lambda x: [x[field] for field in key_fields]
-
-    res = sorted(res,key=key) # itertools.groupby takes a *sorted* iterable
-
-    # First, gather each field for each grouped date
-    res = [{'key':k,'data':[{y:x[y] for y in x.keys() if y not in key_fields} 
-                                 for x in group]} 
-             for k, group 
-             in itertools.groupby(res, key=key)]
-
-
-
-    def agg(r):
-        return {field:agg_key[field]([y[field] for y in r['data']])  for field in agg_key.keys() if field in r['data'][0].keys()}
-
-    def agg_keys(r):
-        return {field:r['key'][i] for i,field in enumerate(key_fields) if field!='datetime_notz'}
+    r = make_response(data)
+    r.mimetype = COLUMN_FORMATS[fmt]
+    return r
 
+def _msgpack_values(column):
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return [None if t is pd.NaT else t.isoformat() for t in column]
+    return column.where(column.notna(), None).tolist()
+    
+    
+## Compression of responses, negotiated from Accept-Encoding
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+def compress_response(response, accept_encodings):
+    """
+    gzip or brotli encode a response if the client accepts it. Streamed responses are compressed as they're sent.
+    Parquet is left alone, its pages are already compressed.
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.mimetype == COLUMN_FORMATS['parquet']):
+        return response
+    
+    encoding = accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None:
+        return response
+    
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        compressor = _compressor(encoding)
+        response.set_data(compressor[0](data) + compressor[1]())
+        
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _compressor(encoding):
+    # (compress, flush) functions
+    if encoding == 'br':
+        c = brotli.Compressor(quality=BROTLI_QUALITY)
+        return c.process, c.finish
+    c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+    return c.compress, c.flush
+
+def _compress_chunks(chunks, encoding):
+    compress, flush = _compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield flush()
 
-    return [{**agg_keys(r), **agg(r)} for r in res]
  
 def trim_datetime(datetime,frequency):
     if frequency == 'h':
@@ -0,0 +1,169 @@
+import os
+import datetime as dt
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from .models import System, Station, Measurement, MeasurementArchive
+
+import logging
+logger = logging.getLogger("Rotating Log")
+
+
+# Closed months of hourly measurements are moved out of the measurement table into one read-only Parquet
+# file per system and month (UTC), so the table and its indexes only hold recent data. Rollups stay in the
+# DB. Each file is listed in measurement_archive and the API reads the files of the months a time range
+# overlaps along with the table, so queries over recent data never open one.
+
+ARCHIVE_COLUMNS = ['station', 'datetime', 'trips', 'returns', 'num_bikes_available', 'num_docks_available', 'distance']
+
+if pyarrow is not None:
+    ARCHIVE_SCHEMA = pyarrow.schema([('station', pyarrow.int64()), ('datetime', pyarrow.timestamp('s')),
+                                     ('trips', pyarrow.int32()), ('returns', pyarrow.int32()),
+                                     ('num_bikes_available', pyarrow.int32()), ('num_docks_available', pyarrow.int32()),
+                                     ('distance', pyarrow.int64())])
+
+# Rows are sorted by station and hour, so delta encoding stores those two in a few bits per row.
+# The counts are small and compress better with dictionary encoding.
+ARCHIVE_WRITE_OPTIONS = {'use_dictionary':['trips', 'returns', 'num_bikes_available', 'num_docks_available'],
+                         'column_encoding':{'station':'DELTA_BINARY_PACKED', 'datetime':'DELTA_BINARY_PACKED'},
+                         'compression':'zstd'}
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("archived measurements require the pyarrow package")
+
+def _month_start(t):
+    return dt.datetime(t.year, t.month, 1)
+
+def _next_month(t):
+    return dt.datetime(t.year + t.month // 12, t.month % 12 + 1, 1)
+
+def archive_path(archive_dir, sys_name, month, archived):
+    # A new file every time a month is (re)written, so a file listed in the DB is never changed
+    return os.path.abspath(os.path.join(archive_dir, sys_name, f"{month:%Y-%m}-{archived:%Y%m%d%H%M%S%f}.parquet"))
+
+def archive_measurements(system, session, archive_dir, keep_months=1, now=None):
+    """
+    Move a system's measurements in months before the last keep_months full months to files in archive_dir.
+    Measurements saved to an archived month later are merged into a new file for it the next time.
+    Returns the months archived.
+    """
+    require_pyarrow()
+
+    cutoff = _month_start(now or dt.datetime.utcnow())
+    for _ in range(keep_months):
+        cutoff = _month_start(cutoff - dt.timedelta(days=1))
+
+    station_ids = session.query(Station.id).filter(Station.system_id==system.id)
+    qry = session.query(func.min(Measurement.datetime)).filter(Measurement.station_id.in_(station_ids))
+    first = qry.filter(Measurement.datetime < cutoff).scalar()
+    if first is None:
+        return []
+
+    months = []
+    month = _month_start(first)
+    while month < cutoff:
+        end = _next_month(month)
+        qry = session.query(Measurement.station_id.label('station'), Measurement.datetime, Measurement.trips,
+                            Measurement.returns, Measurement.num_bikes_available, Measurement.num_docks_available,
+                            Measurement.distance)
+        qry = qry.filter(Measurement.station_id.in_(station_ids), Measurement.datetime >= month, Measurement.datetime < end)
+        mdf = pd.read_sql(qry.statement, session.connection(), parse_dates=['datetime'])
+        if len(mdf) > 0:
+            _archive_month(system, session, archive_dir, month, mdf)
+            months.append(month)
+        month = end
+    return months
+
+def _archive_month(system, session, archive_dir, month, mdf):
+    entry = session.query(MeasurementArchive).filter_by(system_id=system.id, month=month).first()
+    old_path = None
+    if entry is None:
+        entry = MeasurementArchive(system_id=system.id, month=month)
+    else:
+        # Added to the archived rows as update_trips adds to existing measurements (files written
+        # before measurements had a distance don't have the column)
+        old_path = entry.path
+        g = pd.concat([read_archive(old_path), mdf], ignore_index=True).groupby(['station', 'datetime'])
+        mdf = pd.concat([g[['trips', 'returns', 'distance']].sum(min_count=1),
+                         g[['num_bikes_available', 'num_docks_available']].first()], axis=1).reset_index()
+
+    entry.archived = dt.datetime.utcnow()
+    entry.path = archive_path(archive_dir, system.name, month, entry.archived)
+    entry.rows = len(mdf)
+    entry.first_datetime = mdf['datetime'].min().to_pydatetime()
+    entry.last_datetime = mdf['datetime'].max().to_pydatetime()
+    _write_archive(mdf, entry.path)
+
+    # The file is only used once this commits, until then the measurements are read from the table
+    session.add(entry)
+    station_ids = session.query(Station.id).filter(Station.system_id==system.id)
+    qry = session.query(Measurement).filter(Measurement.station_id.in_(station_ids))
+    qry.filter(Measurement.datetime >= month, Measurement.datetime < _next_month(month)).delete(synchronize_session=False)
+    session.commit()
+    logger.info(f"{system.name} archived {len(mdf)} measurements of {month:%Y-%m} to {entry.path}")
+
+    if old_path is not None and os.path.exists(old_path):
+        os.remove(old_path)
+
+def _write_archive(mdf, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mdf = mdf.sort_values(['station', 'datetime'])
+    table = pyarrow.Table.from_pandas(mdf[ARCHIVE_COLUMNS], schema=ARCHIVE_SCHEMA, preserve_index=False)
+    tmp = path + '.tmp'
+    pyarrow.parquet.write_table(table, tmp, **ARCHIVE_WRITE_OPTIONS)
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+
+def read_archive(path, start=None, end=None, stations=None):
+    """
+    Measurements in an archive file, in [start, end) and of the Station ids in stations if given
+    """
+    require_pyarrow()
+    filters = []
+    if start is not None:
+        filters.append(('datetime', '>=', pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('datetime', '<', pd.Timestamp(end)))
+    if stations is not None:
+        filters.append(('station', 'in', list(stations)))
+    return pyarrow.parquet.read_table(path, filters=filters or None).to_pandas()
+
+def archived_months(session, sys_name, start, end):
+    """
+    Archive entries of a system with measurements in [start, end), none if the DB predates the archive
+    """
+    qry = session.query(MeasurementArchive).join(System).filter(System.name==sys_name)
+    qry = qry.filter(MeasurementArchive.first_datetime < end, MeasurementArchive.last_datetime >= start)
+    try:
+        return qry.order_by(MeasurementArchive.month).all()
+    except OperationalError:
+        session.rollback()
+        return []
+
+def read_archives(entries, start=None, end=None, stations=None):
+    """
+    Measurements of several archive entries (see read_archive) in one DataFrame
+    """
+    if len(entries) == 0:
+        return pd.DataFrame(columns=ARCHIVE_COLUMNS)
+    return pd.concat([read_archive(x.path, start, end, stations) for x in entries], ignore_index=True)
+
+def archive_status(session):
+    """
+    [{system, months, rows, first, last}] of every system with archived measurements
+    """
+    qry = session.query(System.name, func.count(MeasurementArchive.id), func.sum(MeasurementArchive.rows),
+                        func.min(MeasurementArchive.month), func.max(MeasurementArchive.month))
+    qry = qry.join(MeasurementArchive, MeasurementArchive.system_id==System.id).group_by(System.name).order_by(System.name)
+    return [{'system':name, 'months':months, 'rows':rows, 'first':first, 'last':last} for name, months, rows, first, last in qry]
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from flask_cors import CORS
-from flask import Flask, request, make_response, send_from_directory,render_template
+from flask import Flask, request, make_response, send_from_directory,render_template, g, has_request_context
 
 import json
 import hashlib
@@ -10,24 +10,109 @@ import pytz
 import datetime as dt
 import itertools
 import os
+import time
+import pandas as pd
 
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, func, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 from flask_sqlalchemy import SQLAlchemy
 
 from .models import System, Station, Measurement
 from .api_functions import *
+from .activity_cache import ActivityCache, CacheEntry
+from .engine_functions import make_engine
+from . import metrics
+from .profiler import SamplingProfiler
 
 app = Flask(__name__)
-CORS(app) #Prevents CORS errors 
+CORS(app, expose_headers=['Link']) #Prevents CORS errors, Link has the next page of paginated responses 
 
 # provisional db, should be overridden in run script
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///bikeraccoon.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS']  = False # Prevents warning
 
-db = SQLAlchemy(app)
+class ReadOnlySQLAlchemy(SQLAlchemy):
+    # The API only reads, from a pool of connections (see make_engine)
+    def create_engine(self, sa_url, engine_opts):
+        return make_engine(sa_url, readonly=True, **engine_opts)
 
+db = ReadOnlySQLAlchemy(app)
 
+# /activity response cache, set ACTIVITY_CACHE_ENTRIES to 0 to disable
+app.config['ACTIVITY_CACHE_ENTRIES'] = 1000
+app.config['ACTIVITY_CACHE_BYTES'] = 256*2**20
+app.config['ACTIVITY_CACHE_FILE'] = None  # sqlite file to persist cached responses
+activity_cache = None
+
+def get_activity_cache():
+    global activity_cache
+    if activity_cache is None:
+        activity_cache = ActivityCache(max_entries=app.config['ACTIVITY_CACHE_ENTRIES'],
+                                       max_bytes=app.config['ACTIVITY_CACHE_BYTES'],
+                                       path=app.config['ACTIVITY_CACHE_FILE'])
+    return activity_cache
+
+
+
+# /metrics. METRICS_TRACKER_FILE is the tracker's metrics_file, its metrics are served along with the API's.
+# Set PROFILE_SLOW_REQUESTS to a number of seconds to sample every request's stack and write a flamegraph
+# (folded stacks) of requests slower than that to PROFILE_DIR.
+app.config['METRICS_TRACKER_FILE'] = None
+app.config['PROFILE_SLOW_REQUESTS'] = None
+app.config['PROFILE_DIR'] = 'profiles'
+app.config['PROFILE_INTERVAL'] = 0.005
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.db_queries = 0
+    if app.config['PROFILE_SLOW_REQUESTS'] is not None:
+        g.profiler = SamplingProfiler(interval=app.config['PROFILE_INTERVAL']).start()
+
+# Registered before compress, after_request functions run in reverse so this sees the response as sent
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    route = _route()
+    duration = time.perf_counter() - g.request_start
+    metrics.request_latency.observe(duration, route=route, method=request.method, status=response.status_code)
+    metrics.db_queries.observe(g.db_queries, route=route)
+    if not response.is_streamed:
+        metrics.response_size.observe(len(response.get_data()), route=route)
+    
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        if duration > app.config['PROFILE_SLOW_REQUESTS']:
+            path = profiler.write(app.config['PROFILE_DIR'], route.strip('/').replace('/', '_') or 'index')
+            app.logger.warning(f"{request.full_path} took {duration:.2f}s, profile written to {path}")
+    return response
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context():
+        metrics.db_query_duration.observe(duration, route=_route())
+        g.db_queries = g.get('db_queries', 0) + 1
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_metrics(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+    
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings)
 
     
 @app.route('/favicon.ico')
@@ -62,11 +147,27 @@ def get_stations():
     
     if sys_name is None:
         return # Add a 404
+    
+    if response_format() in COLUMN_FORMATS:
+        return stations_frame_response(sys_name)
+    
     qry =  db.session.query(Station).join(System).filter(System.name==sys_name,Station.station_id!='free_bikes').all()
     res = [x.as_dict() for x in qry]
 
     return json_response(res)
 
+def stations_frame_response(sys_name):
+    # Read straight into columns, dates are converted from UTC to the system timezone
+    tz = db.session.query(System.tz).filter_by(name=sys_name).first()[0]
+    qry = db.session.query(Station.created_date, Station.name, Station.lat, Station.lon, Station.station_id,
+                           Station.active, Station.disabled_date, System.name.label('system')).join(System) \
+                    .filter(System.name==sys_name,Station.station_id!='free_bikes')
+    df = pd.read_sql(qry.statement, db.session.bind, parse_dates=['created_date','disabled_date'])
+    df[['lat','lon']] = df[['lat','lon']].astype(float)
+    for col in ['created_date','disabled_date']:
+        df[col] = df[col].dt.tz_localize('UTC').dt.tz_convert(tz)
+    return frame_response(df)
+
 @app.route('/activity', methods=['GET'])
 def get_activity():
 
@@ -76,6 +177,9 @@ def get_activity():
     frequency = request.args.get('frequency', default='h', type=str)
     station_id = request.args.get('station', default=None, type=str)
     limit = request.args.get('limit', default=None, type=int)
+    page_size = request.args.get('page_size', default=None, type=int)
+    token = request.args.get('next', default=None, type=str)
+    rank = request.args.get('rank', default='trips', type=str)
    
     # Assume provided time is in system timezone, convert to UTC
     tz = db.session.query(System.tz).filter_by(name=sys_name).first()[0]
@@ -85,11 +189,75 @@ def get_activity():
     except:
         return return_api_error()
     
+    if page_size is not None and (page_size <= 0 or station_id != 'all' or limit is not None):
+        return return_api_error()
+    if rank not in RANKS:
+        return return_api_error()
+    
+    cache = get_activity_cache()
+    key = tuple(sorted(request.args.items(multi=True)))
+    if cache.max_entries > 0:
+        entry = cache.get(key, lambda entry: not updated_since(db.session, entry))
+        if entry is not None:
+            return cached_response(entry)
+    
+    update_id = latest_update_id(db.session)  # read before the data so the entry is never newer than it claims
+    r = _get_activity(sys_name, t1, t2, frequency, station_id, limit, tz, page_size, token, rank)
+    
+    # Entries only keep the body, so paginated responses with a Link header aren't cached
+    if (cache.max_entries > 0 and update_id is not None and r.status_code == 200 and not r.is_streamed
+            and 'Link' not in r.headers):
+        cache.put(key, CacheEntry(sys_name, t1.replace(tzinfo=None), t2.replace(tzinfo=None), update_id,
+                                  r.mimetype, r.get_data()))
+    return r
+
+@app.route('/top', methods=['GET'])
+def get_top():
+    # Station leaderboards of one or more comma separated systems
+    
+    sys_names = request.args.get('system', default='', type=str).split(',')
+    t1 = request.args.get('start', default=None, type=str)
+    t2 = request.args.get('end', default=None, type=str)
+    limit = request.args.get('limit', default=10, type=int)
+    rank = request.args.get('rank', default='trips', type=str)
+    
+    systems = db.session.query(System.name, System.tz).filter(System.name.in_(sys_names)).all()
+    if len(systems) != len(set(sys_names)) or limit == 0 or rank not in RANKS:
+        return return_api_error()
+    try:
+        t1 = string_to_datetime(t1)
+        t2 = string_to_datetime(t2)
+    except:
+        return return_api_error()
+    
+    systems = sorted(systems, key=lambda x: sys_names.index(x[0]))
+    return get_top_stations(db.session, systems, t1, t2, limit, rank)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    text = metrics.api_registry.render()
+    path = app.config['METRICS_TRACKER_FILE']
+    if path is not None and os.path.exists(path):
+        with open(path) as f:
+            text += f.read()
+    r = make_response(text)
+    r.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return r
+
+@app.route('/cache', methods=['GET'])
+def get_cache_stats():
+    return json_response(get_activity_cache().stats())
+
+def _get_activity(sys_name, t1, t2, frequency, station_id, limit, tz, page_size=None, token=None, rank='trips'):
+    
     if station_id is None:      
         return get_system_trips(db.session, t1,t2, sys_name, frequency,tz)
   
+    if station_id == 'all' and page_size is not None:
+        return get_all_stations_page(db.session, t1,t2,sys_name,frequency,tz,page_size,token)
+    
     if station_id == 'all':
-        return get_all_stations_trips(db.session, t1,t2,sys_name,frequency,tz,limit)
+        return get_all_stations_trips(db.session, t1,t2,sys_name,frequency,tz,limit,rank)
     
     # get list of station ids for system
     station_ids = db.session.query(Station.station_id).join(System).filter(System.name==sys_name,Station.id!='free_bikes').all()
@@ -99,7 +267,7 @@ def get_activity():
         return get_station_trips(db.session,t1,t2,sys_name,station_id,frequency,tz)
 
     
-    return return_api_error()
+    return make_response(return_api_error())
 
 
     
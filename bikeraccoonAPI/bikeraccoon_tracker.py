@@ -1,29 +1,56 @@
 import time
-import pandas as pd
+import random
 import datetime as dt
 import sys
+import signal
+import threading
 import sqlite3
 import json
 import logging
+from collections import namedtuple
 from logging.handlers import TimedRotatingFileHandler
 
-from .db_functions import (make_raw_tables, update_free_bikes_raw,
-                         update_stations_raw, update_trips, update_stations,
-                         )
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .db_functions import (make_raw_tables, fetch_stations_raw, fetch_free_bikes_raw,
+                         save_stations_raw, save_free_bikes_raw, update_trips, update_stations,
+                         poll_stats, last_poll, missing_indexes, add_missing_columns, save_trips, clear_raw)
+from .archive_functions import archive_measurements, require_pyarrow
+from .snapshot_store import SnapshotStore
+from .trip_accumulator import TripAccumulator, load_checkpoints, save_checkpoints, drop_checkpoint
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 from .models import Base, System
+from .engine_functions import make_engine
+from .query_functions import discovery_stats, feed_ttl
+from .scheduler import Scheduler, Job, next_local_hour
+from .lease_functions import heartbeat, renew_lease, fair_share, claim_systems, release_systems, release_worker
+from . import metrics
 
 
+# What the scheduler keeps of each tracked system, ORM objects would expire with the session they came from
+TrackedSystem = namedtuple('TrackedSystem', ['id', 'name', 'url', 'tz'])
 
+def start_poll(system, executor):
+    # Query the station status and free bike feeds of a system concurrently, returns their futures
+    return (executor.submit(fetch_stations_raw, system.name, system.url),
+            executor.submit(fetch_free_bikes_raw, system.name, system.url))
 
+def poll_failed(sys_name):
+    # Both feeds failing is a failure, systems without free bikes (or stations) always fail one of them
+    return all(last_poll.get((sys_name, feed)) == 'failed' for feed in ('stations', 'bikes'))
 
+def record_job(job):
+    labels = {'system':job.system or '', 'job':job.kind}
+    metrics.job_next_run.set(job.due, **labels)
+    metrics.job_lateness.set(round(job.lateness, 3), **labels)
+    metrics.job_failures.set(job.failures, **labels)
 
-def get_system_time(system):
-    return pd.Timestamp(dt.datetime.utcnow()).tz_localize('UTC').tz_convert(system.tz)
-
+def forget_job(job):
+    labels = {'system':job.system or '', 'job':job.kind}
+    for metric in (metrics.job_next_run, metrics.job_lateness, metrics.job_failures):
+        metric.remove(**labels)
 
 
 
@@ -34,7 +61,33 @@ def get_system_time(system):
 def tracker(systems_file='systems.json',db_file='bikeraccoon.db', 
             db_file_raw='bikeraccoon-raw.db',log_file=None,
             update_interval=20, query_interval=20, station_check_hour=4,
-            save_temp_data=False):
+            save_temp_data=False, fetch_threads=8, fetch_timeout=30, streaming=False, raw_store=None,
+            metrics_file=None, max_backoff=600, systems_check_interval=60, worker=None, lease_ttl=120,
+            archive_dir=None, archive_keep_months=1):
+    """
+    Each tracked system has its own jobs in a Scheduler: polling its feeds every query_interval seconds
+    (or every ttl seconds if its feeds have a longer ttl), saving trips every update_interval minutes and
+    updating stations daily at station_check_hour local time. Jobs start at random times within their first
+    interval so that DB writes are spread out, and polls of failing systems back off up to max_backoff seconds.
+    The tracked systems are reloaded from the DB every systems_check_interval seconds.
+    
+    To share the systems between several tracker processes, give each a worker name (eg. lease_functions.worker_name())
+    and its own db_file_raw or raw_store. Workers claim an even share of the systems through leases in the main DB,
+    renewed every lease_ttl/3 seconds, and take over the systems of workers that haven't renewed them for lease_ttl
+    seconds. lease_ttl should be longer than the slowest update_trips.
+    
+    With streaming=True trips are computed from the snapshots as they arrive (see TripAccumulator)
+    instead of going through the raw tables. Their state is checkpointed in the raw db when trips are saved and
+    when the tracker stops, a restarted tracker counts the changes since the last checkpoint from its snapshots.
+    If raw_store is a directory, raw snapshots are kept there in a SnapshotStore instead of the raw db tables.
+    If metrics_file is set, tracker metrics are written to it in the Prometheus text format every query_interval
+    seconds (the API serves it on /metrics when METRICS_TRACKER_FILE points to it). These include each job's
+    next run time and how late its last run started.
+    
+    If archive_dir is set, measurements of months before the last archive_keep_months full months are moved daily
+    (an hour after station_check_hour) to Parquet files in archive_dir, see archive_functions.py. The API reads them
+    from there, it needs pyarrow.
+    """
     
     ## SETUP LOGGING
     logger = logging.getLogger("Rotating Log")
@@ -53,76 +106,274 @@ def tracker(systems_file='systems.json',db_file='bikeraccoon.db',
     
     
     ## Setup 
-    ddf = bdf = pd.DataFrame()
-    last_update = dt.datetime.now()
-    query_time = dt.datetime.now()
-    update_delta = dt.timedelta(minutes=update_interval)
+    if archive_dir is not None:
+        require_pyarrow()  # rather than failing in every archive job
     
-    engine = create_engine(f'sqlite:///{db_file}', echo=False)  
+    engine = make_engine(f'sqlite:///{db_file}', echo=False)  
     # This is for the raw tracking to minimize access to the main db
-    engine_raw = create_engine(f'sqlite:///{db_file_raw}', echo=False)  
+    engine_raw = make_engine(f'sqlite:///{db_file_raw}', echo=False)  
+    raw = SnapshotStore(raw_store) if raw_store is not None else engine_raw
     
     
    
     session = Session(engine)
     Base.metadata.create_all(engine)  # Create ORM tables if they don't exist
-
-
-  # Do an initial station update on startup
-    for system in session.query(System).filter(System.is_tracking==True):
-        make_raw_tables(system, engine_raw)
+    add_missing_columns(session)  # and columns, e.g. measurement.distance
+    missing = missing_indexes(session)  # databases that predate them, migrating can take a while so it's left to br-manager.py
+    if len(missing) > 0:
+        logger.warning(f"{db_file} is missing indexes {', '.join(missing)}, run br-manager.py -d {db_file} --migrate "
+                       f"(trips can't be saved without ix_measurement_station_datetime)")
+    
+    if streaming:
+        accumulators = load_checkpoints(engine_raw, [system.name for system in session.query(System)])
+    session.close()
+    
+    executor = ThreadPoolExecutor(max_workers=fetch_threads)
+    scheduler = Scheduler(max_backoff=max_backoff)
+    if worker is not None:
+        systems_check_interval = min(systems_check_interval, lease_ttl / 3)
+    scheduler.add(Job(None, 'systems', systems_check_interval), time.time())
+    if metrics_file is not None:
+        scheduler.add(Job(None, 'metrics', query_interval), time.time() + query_interval)
+    
+    archive_hour = (station_check_hour + 1) % 24
+    
+    tracked = {}  # system name: TrackedSystem, of systems with jobs
+    inflight = {}  # system name: (poll job, stations future, bikes future)
+    last_polled = {}  # system name: time of the last poll
+    
+    
+    def drop_system(name):
+        for kind in ('poll', 'update', 'stations', 'archive'):
+            job = scheduler.remove((name, kind))
+            if job is not None:
+                forget_job(job)
+        metrics.query_interval.remove(system=name)
+        system = tracked.pop(name, None)
+        inflight.pop(name, None)
+        
+        # Another worker may save trips for the system from now on. If it's tracked here again, its first poll
+        # is a new starting point, trips counted from the last snapshot here would add to hours already saved.
+        if streaming:
+            accumulators.pop(name, None)
+            drop_checkpoint(engine_raw, name)
+        elif system is not None:
+            clear_raw(system, raw)
+    
+    
+    def sync_leases(session, systems):
+        # Renew this worker's leases and claim or hand back systems to keep an even share, returns the systems it holds
+        owned = heartbeat(session, worker, lease_ttl)
+        ids = {system.id for system in systems.values()}
+        release_systems(session, worker, owned - ids)  # no longer tracked
+        owned = owned & ids
+        
+        share = fair_share(session, len(ids))
+        if len(owned) > share:
+            # Save trips before handing systems over to the other workers
+            excess = sorted(owned)[share:]
+            for name in [x for x, system in tracked.items() if system.id in excess]:
+                logger.info(f"***{name} handing over to another worker")
+                update_system(session, name)
+                drop_system(name)  # if update_system hasn't already
+            release_systems(session, worker, excess)
+            owned = owned - set(excess)
+        elif len(owned) < share:
+            free = list(ids - owned)
+            random.shuffle(free)  # so workers starting together don't all try the same systems
+            owned = owned | claim_systems(session, worker, free, lease_ttl, share - len(owned))
+        
+        return {name:system for name, system in systems.items() if system.id in owned}
+    
+    
+    def sync_systems(session):
+        # Add jobs for newly tracked systems and drop the jobs of systems no longer tracked (or held by this worker)
+        systems = {system.name:system for system in session.query(System).filter(System.is_tracking==True).all()}
+        if worker is not None:
+            systems = sync_leases(session, systems)
+        
+        for name in set(tracked) - set(systems):
+            logger.info(f"***{name} no longer tracked")
+            drop_system(name)
+        
+        for name, system in systems.items():
+            if name in tracked:
+                tracked[name] = TrackedSystem(system.id, system.name, system.url, system.tz)
+                continue
+            logger.info(f"***{name} tracking")
+            if not streaming and raw_store is None:
+                make_raw_tables(system, engine_raw)
+            try:
+                update_stations(system, session)
+            except Exception as e:
+                session.rollback()
+                logger.warning(f"***{name} updating stations failed: {e}")
+            
+            tracked[name] = TrackedSystem(system.id, system.name, system.url, system.tz)
+            metrics.query_interval.set(query_interval, system=name)
+            record_job(scheduler.add(Job(name, 'poll', query_interval), scheduler.spread(query_interval)))
+            record_job(scheduler.add(Job(name, 'update', update_interval*60), scheduler.spread(update_interval*60)))
+            record_job(scheduler.add(Job(name, 'stations', 86400),
+                                     scheduler.spread(3600, next_local_hour(system.tz, station_check_hour))))
+            if archive_dir is not None:
+                record_job(scheduler.add(Job(name, 'archive', 86400),
+                                         scheduler.spread(3600, next_local_hour(system.tz, archive_hour))))
+    
+    
+    def save_poll(job, ddf, bdf, failed):
+        system = tracked.get(job.system)
+        if system is None:
+            return  # stopped tracking while the poll was running
+        
+        if streaming:
+            acc = accumulators.setdefault(system.name, TripAccumulator(system.name))
+            acc.add_stations(ddf)
+            acc.add_free_bikes(bdf)
+        else:
+            save_stations_raw(system, raw, ddf)
+            save_free_bikes_raw(system, raw, bdf)
+        last_polled[system.name] = dt.datetime.utcnow()
+        
+        interval = max(feed_ttl(system.url) or 0, query_interval)
+        if interval != job.interval:
+            logger.debug(f"{system.name} polling every {interval}s")
+            metrics.query_interval.set(interval, system=system.name)
+        scheduler.done(job, ok=not failed, interval=interval)
+        if failed:
+            logger.debug(f"{system.name} poll failed {job.failures} times, next poll in {job.due - time.time():.0f}s")
+        record_job(job)
+    
+    
+    def update_system(session, name):
+        if worker is not None and not renew_lease(session, worker, tracked[name].id, lease_ttl):
+            logger.warning(f"***{name} lease taken by another worker, not saving trips")
+            drop_system(name)
+            return
+        
+        system = session.query(System).filter(System.name==name).first()
+        if name in last_polled:
+            system.tracking_end = last_polled[name]
+        
+        logger.debug(f"{system.name} polls: {poll_stats.get(system.name, {})}")
+        start = time.perf_counter()
+        try:
+            if streaming:
+                logger.info(f"Updating {system.name} tables")
+                acc = accumulators.setdefault(system.name, TripAccumulator(system.name))
+                save_trips(system, session, acc.hourly_trips())
+                acc.reset()
+                save_checkpoints(engine_raw, {system.name:acc})
+            else:
+                update_trips(system, session, raw, save_temp_data=save_temp_data)
+        except Exception as e:
+            session.rollback()
+            logger.warning(f"***{system.name} saving trips failed: {e}")
+        metrics.update_duration.observe(time.perf_counter() - start, system=system.name)
+    
+    
+    def archive_system(session, job):
+        system = session.query(System).filter(System.name==job.system).first()
+        try:
+            archive_measurements(system, session, archive_dir, archive_keep_months)
+        except Exception as e:
+            session.rollback()
+            logger.warning(f"***{system.name} archiving failed: {e}")
+        return system.tz
+    
+    
+    def check_stations(session, job):
+        system = session.query(System).filter(System.name==job.system).first()
+        logger.info(f"***{system.name} updating stations")
         try:
             update_stations(system, session)
-        except:
+        except Exception as e:
             session.rollback()
-
-    session.close()
+            logger.warning(f"***{system.name} updating stations failed: {e}")
+        return system.tz
+    
+    
+    if worker is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))  # release leases when stopped as a service
     logger.info("Daemon started successfully")
     
-    while True:
+    try:
+        while True:
         
+            # Wait until the next job is due, a fetch finishes or a poll times out. Finished fetches are left out,
+            # wait would return straight away while the other feed of their poll is still running.
+            deadline = min([scheduler.next_due()] + [job.started + fetch_timeout for job, _, _ in inflight.values()])
+            timeout = max(deadline - time.time(), 0)
+            if any(fs.done() and fb.done() for _, fs, fb in inflight.values()):
+                timeout = 0  # finished while the last batch ran
+            futures = [f for _, fs, fb in inflight.values() for f in (fs, fb) if not f.done()]
+            if len(futures) > 0:
+                wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
         
-        if dt.datetime.now() < query_time:
-            time.sleep(1)  # Check whether it's time to update every second (actual query interval time determined by 
-            continue
-        else:
-            query_time = dt.datetime.now() + dt.timedelta(seconds=query_interval)
-
-        logger.info(f"start: {dt.datetime.now()}")
-
-        session = Session(engine)
-        for system in session.query(System).filter(System.is_tracking==True):
-           
-            logger.info(f"***{system.name} - querying station info")
-            update_stations_raw(system, engine_raw)
-
-            update_free_bikes_raw(system, engine_raw)
-
-            system.tracking_end = dt.datetime.utcnow() # Last update
-
-        logger.debug(f"Next DB update: {last_update + update_delta}")
-        if dt.datetime.now() >  last_update + update_delta:
-            last_update = dt.datetime.now()
-
-            for system in session.query(System).filter(System.is_tracking==True):
+            batch_start = time.time()
+        
+            # Save finished polls from this thread, the fetches run in the executor
+            for name, (job, fs, fb) in list(inflight.items()):
+                timed_out = batch_start - job.started > fetch_timeout
+                if not (timed_out or (fs.done() and fb.done())):
+                    continue
+                del inflight[name]
+                if timed_out:
+                    logger.debug(f"{name} gbfs query timed out")
+                    for f in (fs, fb):
+                        f.cancel()
+                ddf, bdf = [f.result() if f.done() and not f.cancelled() else None for f in (fs, fb)]
+                save_poll(job, ddf, bdf, timed_out or poll_failed(name))
+        
+            due = scheduler.pop_due()
+            if len(due) == 0:
+                continue
+            metrics.loop_lag.set(max(job.lateness for job in due))
+        
+            session = Session(engine)
+            for job in due:
+                if job.system is not None and job.system not in tracked:
+                    continue  # dropped earlier in this batch
                 
-                try:
-                    update_trips(system, session, engine_raw, save_temp_data=save_temp_data)
-                except:
-                    session.rollback()
-                    
-                if get_system_time(system).hour == station_check_hour: # check stations at 4am local time
-                    logger.info(f"***{system.name} updating stations")
-                    try:
-                        update_stations(system, session)
-                    except:
-                        session.rollback()
-            
-        session.close()
-            
-        logger.info(f"end: {dt.datetime.now()}")
-        "query_interval"
+                if job.kind == 'poll':
+                    inflight[job.system] = (job, *start_poll(tracked[job.system], executor))
+                    continue
+                
+                if job.kind == 'update':
+                    update_system(session, job.system)
+                    scheduler.done(job)
+                elif job.kind == 'stations':
+                    tz = check_stations(session, job)
+                    scheduler.done(job, due=scheduler.spread(3600, next_local_hour(tz, station_check_hour)))
+                elif job.kind == 'archive':
+                    tz = archive_system(session, job)
+                    scheduler.done(job, due=scheduler.spread(3600, next_local_hour(tz, archive_hour)))
+                elif job.kind == 'systems':
+                    sync_systems(session)
+                    scheduler.done(job)
+                    late = sorted(scheduler.status(), key=lambda x: -x['lateness'])[:3]
+                    logger.debug(f"{len(scheduler.jobs)} jobs, {len(inflight)} polls running, most late: " +
+                                 ', '.join(f"{x['system'] or 'tracker'} {x['job']} {x['lateness']:.1f}s" for x in late))
+                    logger.debug(f"gbfs.json requests: {discovery_stats['requests']}, avoided: {discovery_stats['avoided']}")
+                elif job.kind == 'metrics':
+                    metrics.tracker_registry.write_textfile(metrics_file)
+                    scheduler.done(job)
+                record_job(job)
+            session.close()
+        
+            metrics.loop_duration.set(round(time.time() - batch_start, 3))
 
+    finally:
+        session.close()  # the engine has one connection
+        if streaming:
+            save_checkpoints(engine_raw, accumulators)
+        if worker is not None:
+            # Let the other workers take over straight away
+            session = Session(engine)
+            release_worker(session, worker)
+            session.close()
+            logger.info(f"{worker} released its systems")
 
 
 if __name__ == '__main__':
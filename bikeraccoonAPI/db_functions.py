@@ -1,18 +1,27 @@
+import numpy as np
 import pandas as pd
 
 from sqlalchemy import (Table, Column, Integer, String, MetaData, 
-                        ForeignKey, Float, Date, Time, DateTime, Boolean, func)
+                        ForeignKey, Float, Date, Time, DateTime, Boolean, func, text, bindparam, inspect)
 from sqlalchemy.exc  import OperationalError
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
 
-from .query_functions import query_station_status, query_free_bikes, query_station_info
+from .query_functions import query_station_status, query_free_bikes, query_station_info, FeedNotModified
 
-from .models import Measurement, System, Station, Trip
+from .snapshot_store import SnapshotStore
+from . import metrics
+from .models import Base, Measurement, System, Station, Trip, StationRollup, SystemRollup, MeasurementUpdate, MeasurementArchive, \
+                    MEASUREMENT_UPDATES_KEPT
+from .archive_functions import read_archive
 
 import logging
 logger = logging.getLogger("Rotating Log")
 
 import datetime as dt
 import os
+import threading
+import itertools
         
 
 def make_raw_tables(system, engine):
@@ -38,44 +47,107 @@ def make_raw_tables(system, engine):
     metadata.create_all(engine)  # Doesn't overwrite tables if exist
     
     
-def update_stations_raw(system, engine):
-    # Query stations and save to temp table
+# The fetch functions only take plain values so they can run in the tracker's fetch threads,
+# the save functions are called from the single thread that writes to the DB
+
+# Counts of processed, skipped (feed unchanged) and failed polls by system name and feed,
+# and the outcome of the latest poll by (system name, feed)
+poll_stats = {}
+last_poll = {}
+_poll_stats_lock = threading.Lock()
+
+def count_poll(sys_name, feed, outcome):
+    with _poll_stats_lock:
+        stats = poll_stats.setdefault(sys_name, {})
+        stats[f"{feed}_{outcome}"] = stats.get(f"{feed}_{outcome}", 0) + 1
+        last_poll[(sys_name, feed)] = outcome
+    metrics.polls.inc(system=sys_name, feed=feed, outcome=outcome)
+
+def observe_fetch(sys_name, feed, timings):
+    if 'fetch' in timings:
+        metrics.fetch_latency.observe(timings['fetch'], system=sys_name, feed=feed)
+        metrics.parse_time.observe(timings['parse'], system=sys_name, feed=feed)
+    
+def fetch_stations_raw(sys_name, sys_url):
+    # Query stations, returns None on failure or if the feed hasn't changed since the last query
+    timings = {}
     try:
-        ddf = query_station_status(system.url)
+        ddf = query_station_status(sys_url, conditional=True, timings=timings)
         ddf['station_id'] = ddf['station_id'].astype(str) 
+    except FeedNotModified:
+        count_poll(sys_name, 'stations', 'skipped')
+        return
     except Exception as e:
-        logger.debug(f"{system.name} gbfs query error, skipping stations_raw db update: {e}")
+        logger.debug(f"{sys_name} gbfs query error, skipping stations_raw db update: {e}")
+        count_poll(sys_name, 'stations', 'failed')
         return 
-        
-    ddf.to_sql(f"{system.name}_stations_raw",engine,if_exists='append',index=False)
-    
-def update_free_bikes_raw(system, engine):
+    count_poll(sys_name, 'stations', 'processed')
+    observe_fetch(sys_name, 'stations', timings)
+    return ddf
+
+def fetch_free_bikes_raw(sys_name, sys_url):
+    timings = {}
     try:
-        bdf = query_free_bikes(system.url)
+        bdf = query_free_bikes(sys_url, conditional=True, timings=timings)
+    except FeedNotModified:
+        count_poll(sys_name, 'bikes', 'skipped')
+        return
     except Exception as e:
-        logger.debug(f"{system.name} gbfs query error, skipping free_bikes_raw db update: {e}")
+        logger.debug(f"{sys_name} gbfs query error, skipping free_bikes_raw db update: {e}")
+        count_poll(sys_name, 'bikes', 'failed')
         return 
-
+    count_poll(sys_name, 'bikes', 'processed')
+    observe_fetch(sys_name, 'bikes', timings)
+    return bdf
+    
+def save_stations_raw(system, engine, ddf):
+    # Save stations to temp table (engine can also be a SnapshotStore)
+    if ddf is None:
+        return
+    if isinstance(engine, SnapshotStore):
+        engine.append_stations(system.name, ddf)
+        return
+    ddf.to_sql(f"{system.name}_stations_raw",engine,if_exists='append',index=False)
+    metrics.rows_written.inc(len(ddf), system=system.name, table='stations_raw')
+    
+def save_free_bikes_raw(system, engine, bdf):
+    if bdf is None:
+        return
+    if isinstance(engine, SnapshotStore):
+        engine.append_free_bikes(system.name, bdf)
+        return
     bdf.to_sql(f"{system.name}_bikes_raw",engine,if_exists='append',index=False)
+    metrics.rows_written.inc(len(bdf), system=system.name, table='bikes_raw')
     
     
     
     
-def map_station_id_to_station(station_id,system,session):
+def station_id_map(system, session):
     """
-    Given a station_id string and a system obj, return a station ORM object
-    with the latest 'created_by' date for that station_id and system
+    Map each station_id string of a system to the id of its Station with the latest 'created_date'
     """
+    qry = session.query(Station.station_id, Station.id).filter(Station.system_id==system.id)
+    qry = qry.order_by(Station.created_date, Station.id.desc())
     
-    qry = session.query(Station).join(System).filter(System.name==system.name)
-    qry = qry.filter(Station.station_id==station_id).order_by(Station.created_date.desc())
-    
-    return qry.first()
+    return {station_id:id for station_id,id in qry}  # later stations overwrite earlier ones
+
+
+def _int_or_none(x):
+    return None if pd.isna(x) else int(x)
     
+# Inserts a new hourly measurement, or adds trips and returns to an existing one (sqlite >= 3.24 or postgres)
+UPSERT_MEASUREMENT = text("""
+    insert into measurement (station_id, datetime, trips, returns, num_bikes_available, num_docks_available, distance)
+    values (:station_id, :datetime, :trips, :returns, :num_bikes_available, :num_docks_available, :distance)
+    on conflict (station_id, datetime) do update
+    set trips = measurement.trips + excluded.trips, returns = measurement.returns + excluded.returns,
+        distance = coalesce(measurement.distance + excluded.distance, measurement.distance, excluded.distance)
+    """).bindparams(bindparam('datetime', type_=DateTime))
+
 def update_trips(system, session, engine_raw, save_temp_data=False):
     
     """
-    Pulls raw data from raw db, computes trips, saves trip data to main db via session
+    Pulls raw data from raw db (or SnapshotStore), computes trips, saves trip data to main db via session
     """
     
 
@@ -83,16 +155,22 @@ def update_trips(system, session, engine_raw, save_temp_data=False):
 
 
     ## Compute hourly station trips, append to trips table
-    try:
-        ddf = pd.read_sql(f"select * from {system.name}_stations_raw",engine_raw, parse_dates='datetime')   
-    except OperationalError:
-        ddf = pd.DataFrame()
+    if isinstance(engine_raw, SnapshotStore):
+        ddf = engine_raw.read_stations(system.name)
+    else:
+        try:
+            ddf = pd.read_sql(f"select * from {system.name}_stations_raw",engine_raw, parse_dates='datetime')   
+        except OperationalError:
+            ddf = pd.DataFrame()
         
     ## Compute hourly free bike trips, append to trips table
-    try:
-        bdf = pd.read_sql(f"select * from {system.name}_bikes_raw",engine_raw, parse_dates='datetime')  
-    except OperationalError:
-        bdf = pd.DataFrame()
+    if isinstance(engine_raw, SnapshotStore):
+        bdf = engine_raw.read_free_bikes(system.name)
+    else:
+        try:
+            bdf = pd.read_sql(f"select * from {system.name}_bikes_raw",engine_raw, parse_dates='datetime')  
+        except OperationalError:
+            bdf = pd.DataFrame()
         
     thdf = pd.concat([make_free_bike_trips(bdf), make_station_trips(ddf)], sort=True)
 
@@ -106,44 +184,419 @@ def update_trips(system, session, engine_raw, save_temp_data=False):
         ddf.to_csv(f'./logs/station_data-{system.name}-{time_slug}.csv', index=False)
         bdf.to_csv(f'./logs/bike_data-{system.name}-{time_slug}.csv', index=False)
         
-    ## Get station objects to match to records  
-    try:
-        thdf['station'] = thdf['station_id'].apply(map_station_id_to_station,args=(system,session))
-    except Exception as e:
-        logger.debug(f"Updating {system.name} tables failed due to exception: {e}")
-        return 
+    if len(thdf) == 0:
+        return
+    
+    save_trips(system, session, thdf)
+    
+    # Drop records in raw tables except for most recent query
+    if isinstance(engine_raw, SnapshotStore):
+        engine_raw.trim(system.name)
+        return
+    trim_raw(f"{system.name}_stations_raw", engine_raw)
+    trim_raw(f"{system.name}_bikes_raw", engine_raw)
+    
+    
+def save_trips(system, session, thdf):
+    """
+    Save hourly trips (output of make_station_trips/make_free_bike_trips) to the measurement and rollup tables
+    """
+    if len(thdf) == 0:
+        return
+    
+    ## Match records to Station.id
+    stations = station_id_map(system, session)
+    thdf['station'] = thdf['station_id'].map(stations)
+    unknown = thdf['station'].isna().values
+    if unknown.any():
+        logger.debug(f"{system.name} skipping measurements for unknown stations {list(thdf['station_id'][unknown].unique())}")
+        thdf = thdf[~unknown].copy()
+    thdf['station'] = thdf['station'].astype(int)
       
+    thdf['free_bikes'] = thdf['station_id'] == 'free_bikes'
     del thdf['station_id'] # Not needed anymore
+    t = pd.to_datetime(thdf['datetime'], utc=True).dt.tz_localize(None)
+    
+    # Records that are added to an existing measurement only contribute trips and returns to rollups
+    qry = session.query(Measurement.station_id, Measurement.datetime)
+    qry = qry.filter(Measurement.station_id.in_(thdf['station'].unique().tolist()))
+    qry = qry.filter(Measurement.datetime.between(t.min().to_pydatetime(), t.max().to_pydatetime()))
+    existing = set(qry)
+    thdf['new'] = [(s, d) not in existing for s,d in zip(thdf['station'], t.dt.to_pydatetime())]
+    update_rollups(system, session, thdf)
+    
+    # Add rows to measurements table, distance is only known for free bikes
+    distances = thdf['distance'] if 'distance' in thdf else itertools.repeat(None)
+    records = [{'station_id':int(s), 'datetime':d, 'trips':_int_or_none(trips), 'returns':_int_or_none(returns),
+                'num_bikes_available':_int_or_none(bikes), 'num_docks_available':_int_or_none(docks),
+                'distance':_int_or_none(distance)}
+               for s,d,trips,returns,bikes,docks,distance in zip(thdf['station'], t.dt.to_pydatetime(),
+                                                                thdf['trips'], thdf['returns'],
+                                                                thdf['num_bikes_available'], thdf['num_docks_available'],
+                                                                distances)]
+    session.execute(UPSERT_MEASUREMENT, records)
+    log_measurement_update(system, session, t.min().to_pydatetime(), t.max().to_pydatetime())
+    session.commit()
+    metrics.rows_written.inc(len(records), system=system.name, table='measurement')
     
-    records = thdf.to_dict('records')  # convert dataframe as to a list of dicts
     
-    def update_existing_record(record):
-        """
-        For a given Measurement record, update an existing record
-        or create a new Measurement object
-        """
-        # Try to get existing record
-        existing_record = session.query(Measurement).filter_by(datetime=record['datetime'],station=record['station']).first()
 
-        if existing_record is not None:
-            existing_record.trips = existing_record.trips + record['trips']
-            existing_record.returns = existing_record.returns + record['returns']
-            return existing_record
-        else:
-            return Measurement(**record)
+def log_measurement_update(system, session, first=dt.datetime.min, last=dt.datetime.max):
+    """
+    Record that measurements for a system between first and last (UTC hours, inclusive)
+    have changed, so that the API drops cached responses. Doesn't commit.
+    Only the latest MEASUREMENT_UPDATES_KEPT records of the system are kept.
+    """
+    session.add(MeasurementUpdate(system_id=system.id, first_datetime=first, last_datetime=last))
+    session.flush()
     
-    # Add rows to measurements table
-    session.add_all([update_existing_record(r) for r in records])
-    session.commit()
+    qry = session.query(MeasurementUpdate.id).filter(MeasurementUpdate.system_id==system.id)
+    oldest = qry.order_by(MeasurementUpdate.id.desc()).offset(MEASUREMENT_UPDATES_KEPT - 1).limit(1).scalar()
+    if oldest is not None:
+        qry.filter(MeasurementUpdate.id < oldest).delete(synchronize_session=False)
+    
+
+ROLLUP_FREQUENCIES = ['d','m','y']
+ROLLUP_VALUES = ['trips','returns','num_bikes_total','num_docks_total','n_measurements',
+                 'free_bike_trips','free_bike_returns','free_bike_measurements']
 
+def _period_start(local, frequency):
+    """
+    Vectorized version of api_functions.trim_datetime for a series of naive local datetimes
+    """
+    offset = local - local.dt.floor('h')  # keep minutes for systems with half-hour UTC offsets
+    if frequency == 'd':
+        start = local.dt.floor('D')
+    elif frequency == 'm':
+        start = local.dt.to_period('M').dt.to_timestamp()
+    elif frequency == 'y':
+        start = local.dt.to_period('Y').dt.to_timestamp()
+    return start + offset
+
+def _merge_rollups(df, keys):
+    agg = {c:'sum' for c in ROLLUP_VALUES if c in df.columns}
+    agg['first_datetime'] = 'min'
+    return df.groupby(keys).agg(agg).reset_index()
+
+def make_rollups(mdf, tz):
+    """
+    Aggregate hourly measurements into local day, month and year rollups.
+    mdf needs columns station (Station.id), free_bikes, datetime (UTC), trips, returns,
+    num_bikes_available, num_docks_available and new (False if the hour is already in the DB).
+    Returns a station rollup frame and a system rollup frame.
+    """
+    
+    mdf = mdf.copy()
+    t = pd.to_datetime(mdf['datetime'], utc=True)
+    mdf['first_datetime'] = t.dt.tz_localize(None)
+    local = t.dt.tz_convert(tz).dt.tz_localize(None)
+    
+    new = mdf['new'].astype(bool)
+    free_bikes = mdf['free_bikes'].astype(bool)
+    mdf['trips'] = mdf['trips'].fillna(0)
+    mdf['returns'] = mdf['returns'].fillna(0)
+    mdf['num_bikes_total'] = mdf['num_bikes_available'].fillna(0).where(new, 0)
+    mdf['num_docks_total'] = mdf['num_docks_available'].fillna(0).where(new, 0)
+    mdf['n_measurements'] = new.astype(int)
+    mdf['free_bike_trips'] = mdf['trips'].where(free_bikes, 0)
+    mdf['free_bike_returns'] = mdf['returns'].where(free_bikes, 0)
+    mdf['free_bike_measurements'] = (new & free_bikes).astype(int)
+    
+    srdfs = []
+    sysdfs = []
+    for frequency in ROLLUP_FREQUENCIES:
+        mdf['frequency'] = frequency
+        mdf['datetime'] = _period_start(local, frequency)
+        srdfs.append(_merge_rollups(mdf[['station','frequency','datetime','first_datetime','trips','returns',
+                                         'num_bikes_total','num_docks_total','n_measurements']],
+                                    ['station','frequency','datetime']))
+        sysdfs.append(_merge_rollups(mdf[['frequency','datetime','first_datetime','trips','returns',
+                                          'free_bike_trips','free_bike_returns','free_bike_measurements']],
+                                     ['frequency','datetime']))
+        
+    return pd.concat(srdfs), pd.concat(sysdfs)
+    
+def _rollup_records(df):
+    """
+    Convert a rollup frame to a list of dicts of plain python types (sqlite can't bind numpy ints)
+    """
+    records = []
+    for r in df.to_dict('records'):
+        r = {k:int(v) if k in ROLLUP_VALUES or k in ('station','station_id','system_id') else v for k,v in r.items()}
+        r['datetime'] = r['datetime'].to_pydatetime()
+        r['first_datetime'] = r['first_datetime'].to_pydatetime()
+        records.append(r)
+    return records
+    
+def update_rollups(system, session, mdf):
+    """
+    Add a batch of hourly measurements to the station and system rollup tables.
+    See make_rollups for the format of mdf. Doesn't commit.
+    """
+    
+    if len(mdf) == 0:
+        return
     
+    srdf, sysdf = make_rollups(mdf, system.tz)
+    periods = sorted(set(srdf['datetime'].dt.to_pydatetime()))
     
+    qry = session.query(StationRollup).join(Station).filter(Station.system_id==system.id)
+    qry = qry.filter(StationRollup.datetime.in_(periods))
+    existing = {(x.station_id, x.frequency, x.datetime):x for x in qry}
     
-    # Drop records in raw tables except for most recent query
-    trim_raw(f"{system.name}_stations_raw", engine_raw)
-    trim_raw(f"{system.name}_bikes_raw", engine_raw)
+    for r in _rollup_records(srdf):
+        station = r.pop('station')
+        rollup = existing.get((station, r['frequency'], r['datetime']))
+        if rollup is None:
+            session.add(StationRollup(station_id=station, **r))
+            continue
+        rollup.first_datetime = min(rollup.first_datetime, r['first_datetime'])
+        for c in ['trips','returns','num_bikes_total','num_docks_total','n_measurements']:
+            setattr(rollup, c, getattr(rollup, c) + r[c])
+    
+    qry = session.query(SystemRollup).filter(SystemRollup.system_id==system.id)
+    qry = qry.filter(SystemRollup.datetime.in_(periods))
+    existing = {(x.frequency, x.datetime):x for x in qry}
+    
+    for r in _rollup_records(sysdf):
+        rollup = existing.get((r['frequency'], r['datetime']))
+        if rollup is None:
+            session.add(SystemRollup(system_id=system.id, **r))
+            continue
+        rollup.first_datetime = min(rollup.first_datetime, r['first_datetime'])
+        for c in ['trips','returns','free_bike_trips','free_bike_returns','free_bike_measurements']:
+            setattr(rollup, c, getattr(rollup, c) + r[c])
+            
+def rebuild_rollups(system, session, chunksize=500000):
+    """
+    Drop and recompute all rollups for a system from the measurement table and its archived months
+    """
+    logger.info(f"{system.name} rebuilding rollups")
+    
+    station_ids = session.query(Station.id).filter(Station.system_id==system.id)
+    session.query(StationRollup).filter(StationRollup.station_id.in_(station_ids)).delete(synchronize_session=False)
+    session.query(SystemRollup).filter(SystemRollup.system_id==system.id).delete(synchronize_session=False)
+    
+    qry = session.query(Measurement.station_id.label('station'),
+                        (Station.station_id=='free_bikes').label('free_bikes'),
+                        Measurement.datetime, Measurement.trips, Measurement.returns,
+                        Measurement.num_bikes_available, Measurement.num_docks_available)
+    qry = qry.join(Station).filter(Station.system_id==system.id)
+    
+    srdfs = []
+    sysdfs = []
+    chunks = pd.read_sql(qry.statement, session.connection(), parse_dates=['datetime'], chunksize=chunksize)
+    for mdf in itertools.chain(chunks, _archived_chunks(system, session)):
+        mdf['new'] = True
+        srdf, sysdf = make_rollups(mdf, system.tz)
+        srdfs.append(srdf)
+        sysdfs.append(sysdf)
+        
+    if len(srdfs) == 0:
+        session.commit()
+        return
+        
+    # Periods can be split across chunks
+    srdf = _merge_rollups(pd.concat(srdfs), ['station','frequency','datetime']).rename(columns={'station':'station_id'})
+    sysdf = _merge_rollups(pd.concat(sysdfs), ['frequency','datetime'])
+    sysdf['system_id'] = system.id
+    
+    session.bulk_insert_mappings(StationRollup, _rollup_records(srdf))
+    session.bulk_insert_mappings(SystemRollup, _rollup_records(sysdf))
+    session.commit()
+    logger.info(f"{system.name} rollups rebuilt")
+    
+    
+def _archived_chunks(system, session):
+    # Archived measurements of a system a month at a time, with the columns of rebuild_rollups' query
+    free_bikes = dict(session.query(Station.id, Station.station_id=='free_bikes').filter(Station.system_id==system.id))
+    for entry in session.query(MeasurementArchive).filter(MeasurementArchive.system_id==system.id).order_by(MeasurementArchive.month):
+        mdf = read_archive(entry.path, stations=list(free_bikes))
+        mdf['free_bikes'] = mdf['station'].map(free_bikes).astype(bool)
+        yield mdf
+    
+def migrate_measurements(session):
+    """
+    Merge duplicate measurements for the same station and hour into the row with the lowest id
+    (trips and returns are summed) and add the unique index that update_trips upserts against.
+    Rollups of systems with duplicates are rebuilt. Does nothing if the index already exists.
+    """
+    indexes = inspect(session.connection()).get_indexes('measurement')
+    if any(ix['name'] == 'ix_measurement_station_datetime' for ix in indexes):
+        return
+    
+    dup_systems = session.execute("""select distinct station.system_id from measurement join station on station.id = measurement.station_id
+                                     group by measurement.station_id, measurement.datetime having count(*) > 1""").fetchall()
+    dup_systems = [x[0] for x in dup_systems]
+    
+    if len(dup_systems) > 0:
+        logger.info(f"Merging duplicate measurements for systems {dup_systems}")
+        session.execute("""update measurement set 
+                             trips = (select sum(m.trips) from measurement m 
+                                      where m.station_id = measurement.station_id and m.datetime = measurement.datetime),
+                             returns = (select sum(m.returns) from measurement m 
+                                        where m.station_id = measurement.station_id and m.datetime = measurement.datetime)
+                           where id in (select min(id) from measurement group by station_id, datetime having count(*) > 1)""")
+        session.execute("""delete from measurement 
+                           where id not in (select min(id) from measurement group by station_id, datetime)""")
+        
+    session.execute("create unique index ix_measurement_station_datetime on measurement (station_id, datetime)")
+    session.commit()
+    
+    for system in session.query(System).filter(System.id.in_(dup_systems)):
+        log_measurement_update(system, session)
+        rebuild_rollups(system, session)
+    
+
+# Single column indexes of databases that predate the composite indexes in models.py, which start with the same column,
+# and the measurement datetime index, which no query uses since they all filter on station_id too
+REDUNDANT_INDEXES = ['ix_measurement_station_id', 'ix_measurement_datetime', 'ix_station_system_id',
+                     'ix_station_rollup_station_id', 'ix_system_rollup_system_id']
+
+# Moves a station's measurements to another station of the same system, adding trips and returns to its rows
+# for the same hour. Where only one of the rows has a value (not null) it is kept.
+MERGE_MEASUREMENTS = text("""
+    insert into measurement (station_id, datetime, trips, returns, num_bikes_available, num_docks_available, distance)
+    select :keep, datetime, trips, returns, num_bikes_available, num_docks_available, distance from measurement where station_id = :other
+    on conflict (station_id, datetime) do update
+    set trips = coalesce(measurement.trips + excluded.trips, measurement.trips, excluded.trips),
+        returns = coalesce(measurement.returns + excluded.returns, measurement.returns, excluded.returns),
+        distance = coalesce(measurement.distance + excluded.distance, measurement.distance, excluded.distance),
+        num_bikes_available = coalesce(measurement.num_bikes_available, excluded.num_bikes_available),
+        num_docks_available = coalesce(measurement.num_docks_available, excluded.num_docks_available)
+    """)
+
+def merge_duplicate_stations(session):
+    """
+    Merge stations of a system with the same station_id into the one station_id_map picks (the latest created),
+    so that the unique station index can be added. Rollups of systems with duplicates are rebuilt.
+    """
+    dups = session.execute("""select system_id, station_id from station 
+                              group by system_id, station_id having count(*) > 1""").fetchall()
+    if len(dups) == 0:
+        return
+    
+    for system_id, station_id in dups:
+        qry = session.query(Station.id).filter(Station.system_id==system_id, Station.station_id==station_id)
+        ids = [x for x, in qry.order_by(Station.created_date, Station.id.desc())]
+        keep = ids[-1]
+        logger.info(f"Merging stations {ids[:-1]} into {keep} (system {system_id} station_id {station_id})")
+        for other in ids[:-1]:
+            session.execute(MERGE_MEASUREMENTS, {'keep':keep, 'other':other})
+            session.query(Measurement).filter(Measurement.station_id==other).delete(synchronize_session=False)
+            session.query(Trip).filter(Trip.departure_station_id==other).update({'departure_station_id':keep}, synchronize_session=False)
+            session.query(Trip).filter(Trip.return_station_id==other).update({'return_station_id':keep}, synchronize_session=False)
+            session.query(StationRollup).filter(StationRollup.station_id==other).delete(synchronize_session=False)
+            session.query(Station).filter(Station.id==other).delete(synchronize_session=False)
+    session.commit()
+    
+    for system in session.query(System).filter(System.id.in_({x[0] for x in dups})):
+        log_measurement_update(system, session)
+        rebuild_rollups(system, session)
+        
+def add_missing_columns(session):
+    """
+    Add the nullable columns in models.py that a database's tables predate (adding one doesn't rewrite
+    the table, so it's quick). Returns the names of the columns added as table.column
+    """
+    connection = session.connection()
+    tables = set(inspect(connection).get_table_names())
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {x['name'] for x in inspect(connection).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable and not column.primary_key:
+                logger.info(f"Adding column {table.name}.{column.name}")
+                session.execute(f"alter table {table.name} add column {column.name} {column.type.compile(connection.dialect)}")
+                added.append(f"{table.name}.{column.name}")
+    session.commit()
+    return added
+    
+def _index_names(connection):
+    return {ix['name'] for table in Base.metadata.tables for ix in inspect(connection).get_indexes(table)}
+
+def missing_indexes(session):
+    """
+    Names of the indexes in models.py that the database doesn't have yet, migrate_indexes adds them
+    """
+    existing = _index_names(session.connection())
+    return [index.name for table in Base.metadata.sorted_tables for index in table.indexes if index.name not in existing]
+
+def migrate_indexes(session, analyze=False):
+    """
+    Add the columns and indexes in models.py that a database predates and drop the REDUNDANT_INDEXES they replace,
+    after merging duplicate stations and measurements. Refreshes the query planner statistics
+    (ANALYZE, which sqlite needs to choose the composite indexes) if analyze is True, anything changed
+    or there are none. Returns the names of the indexes added and dropped.
+    """
+    add_missing_columns(session)
+    migrate_measurements(session)
+    merge_duplicate_stations(session)
+    
+    connection = session.connection()
+    existing = _index_names(connection)
+    
+    added = []
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Adding index {index.name}")
+                index.create(connection)
+                added.append(index.name)
+    
+    dropped = [x for x in REDUNDANT_INDEXES if x in existing]
+    for name in dropped:
+        logger.info(f"Dropping index {name}")
+        session.execute(f"drop index {name}")
+    session.commit()
+    
+    has_stats = session.execute("""select count(*) from sqlite_master where type = 'table' and name = 'sqlite_stat1'""").scalar() > 0
+    if has_stats:
+        has_stats = session.execute("""select count(*) from sqlite_stat1 where tbl = 'measurement'""").scalar() > 0
+    if analyze or len(added) > 0 or len(dropped) > 0 or not has_stats:
+        session.execute("pragma analysis_limit = 1000")  # sample each index instead of reading all of it
+        session.execute("analyze")
+        session.commit()
+    
+    return added, dropped
+
+
+class ExplainQueryPlan(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(ExplainQueryPlan)
+def _compile_explain_query_plan(element, compiler, **kw):
+    return "explain query plan " + compiler.process(element.statement, **kw)
+
+def explain_query_plan(session, qry):
+    """
+    sqlite's plan for an ORM query, one line per step indented by depth
+    """
+    rows = session.execute(ExplainQueryPlan(qry.statement)).fetchall()
+    depth = {0:-1}
+    lines = []
+    for id, parent, _, detail in rows:
+        depth[id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[id] + detail)
+    return lines
     
+
+def clear_raw(system, engine_raw):
+    """
+    Drop all of a system's raw snapshots (engine_raw can also be a SnapshotStore), so that trips aren't
+    counted from a snapshot older than the next one
+    """
+    if isinstance(engine_raw, SnapshotStore):
+        engine_raw.clear(system.name)
+        return
     
+    m = MetaData(bind=engine_raw, reflect=True)
+    for tablename in (f"{system.name}_stations_raw", f"{system.name}_bikes_raw"):
+        if tablename in m.tables:
+            m.tables[tablename].delete().execute()
     
 
 def trim_raw(tablename, engine_raw):
@@ -167,78 +620,130 @@ def trim_raw(tablename, engine_raw):
     
  
     
+HOUR_NS = 3600 * 10**9
+
 def make_station_trips(ddf):
+    """
+    Hourly trips and returns for each station from consecutive station_status snapshots.
+    A station's change in num_bikes_available is counted if it reported (non null) in both snapshots,
+    in the hour of the earlier snapshot. Every station gets a row for every hour with a snapshot.
+    """
     
     if len(ddf) == 0:
         return pd.DataFrame()
     
-    pdf = pd.pivot_table(ddf,columns='station_id',index='datetime',values='num_bikes_available')
-    df = pdf.copy()
-    for col in pdf.columns:
-        df[col] = pdf[col] - pdf[col].shift(-1)
-    df = df.fillna(0.0).astype(int)
-
-    df_stack = df.stack(level=0).reset_index()
-    df_stack.columns = ['datetime','station_id','trips']
-
-    df_stack['returns'] = df_stack['trips']
-    df_stack.loc[df_stack['returns']<0,'returns'] = 0
-
-    df_stack.loc[df_stack['trips']>0,'trips'] = 0
-    df_stack['trips'] = -1*df_stack['trips']
-
-    df_stack = df_stack.set_index('datetime').groupby([pd.Grouper(freq='h'),'station_id']).sum().reset_index()
+    df = ddf[ddf['num_bikes_available'].notna()]
+    if len(df) == 0:
+        return pd.DataFrame()
+    times = pd.DatetimeIndex(pd.to_datetime(df['datetime']))
+    
+    # Index snapshots by time and stations by station_id, both sorted
+    snapshot, snapshot_times = pd.factorize(times.asi8, sort=True)
+    station, station_ids = pd.factorize(df['station_id'].values, sort=True)
+    n_snapshots, n_stations = len(snapshot_times), len(station_ids)
+    
+    # Mean bikes for each station and snapshot (stations can be reported twice), sorted by station then time
+    key, keys = pd.factorize(station * n_snapshots + snapshot, sort=True)
+    bikes = np.bincount(key, weights=df['num_bikes_available'].values.astype(float)) / np.bincount(key)
+    station, snapshot = keys // n_snapshots, keys % n_snapshots
+    
+    # Change to the station's value in the next snapshot, if it reported in that snapshot
+    change = np.zeros(len(keys), dtype=int)
+    consecutive = (station[1:] == station[:-1]) & (snapshot[1:] == snapshot[:-1] + 1)
+    change[:-1][consecutive] = (bikes[:-1] - bikes[1:])[consecutive].astype(int)
+    
+    # Sum by hour of the earlier snapshot
+    hours, snapshot_hour = np.unique(snapshot_times // HOUR_NS, return_inverse=True)
+    bucket = snapshot_hour[snapshot] * n_stations + station
+    returns = np.bincount(bucket, weights=np.where(change > 0, change, 0), minlength=len(hours)*n_stations)
+    trips = np.bincount(bucket, weights=np.where(change < 0, -change, 0), minlength=len(hours)*n_stations)
+    
+    hours = pd.DatetimeIndex(hours * HOUR_NS)
+    if times.tz is not None:
+        hours = hours.tz_localize('UTC').tz_convert(times.tz)
+    
+    df_stack = pd.DataFrame({'datetime':np.repeat(hours, n_stations),
+                             'station_id':np.tile(station_ids.astype(object), len(hours)),
+                             'trips':trips.astype(np.int64), 'returns':returns.astype(np.int64)})
     
     # Add available bikes and docks
-    num_bikes_xw = ddf.groupby('station_id').max()['num_bikes_available'].to_dict()
-    num_docks_xw = ddf.groupby('station_id').max()['num_docks_available'].to_dict()
+    xw = ddf.groupby('station_id')[['num_bikes_available','num_docks_available']].max()
 
-    df_stack['num_bikes_available'] = df_stack['station_id'].map(num_bikes_xw)
-    df_stack['num_docks_available'] = df_stack['station_id'].map(num_docks_xw)
+    df_stack['num_bikes_available'] = df_stack['station_id'].map(xw['num_bikes_available'])
+    df_stack['num_docks_available'] = df_stack['station_id'].map(xw['num_docks_available'])
     
     return df_stack
 
 
-
 def make_free_bike_trips(bdf):
+    """
+    Hourly free bike trips and returns: the bikes that disappear/appear between consecutive free_bike_status
+    snapshots, counted in the hour of the earlier snapshot. distance is the total straight line movement of bikes
+    (metres) between consecutive sightings of each, counted in the hour of the earlier sighting. A bike that
+    disappears for a trip and reappears elsewhere has moved the trip's distance.
+    """
     
     if len(bdf) == 0:
         return pd.DataFrame()
     
+    times = pd.DatetimeIndex(pd.to_datetime(bdf['datetime']))
     
+    # Index snapshots by time and bikes by bike_id, snapshots sorted
+    snapshot, snapshot_times = pd.factorize(times.asi8, sort=True)
+    bike, bike_ids = pd.factorize(bdf['bike_id'].values)
+    n_snapshots = len(snapshot_times)
+    if n_snapshots < 2:
+        return pd.DataFrame()
     
-    n_bikes = 0
-    bikes = {}
-    for t,df in bdf.groupby('datetime'):
-        active_bikes = set(df['bike_id'])
-        bikes[t] = active_bikes
-        n_bikes = n_bikes if len(active_bikes) < n_bikes else len(active_bikes)
-
-    t = {}
-    keys = sorted(bikes.keys())
-    for i in range(len(keys)-1):
-
-        time = keys[i]
-        trips_started = len(bikes[keys[i]].difference(bikes[keys[i+1]]))
-        trips_ended = len(bikes[keys[i+1]].difference(bikes[keys[i]]))
-
-        t[i] = {'trips':trips_started,'returns':trips_ended,'datetime':time}
-
-
-    df = pd.DataFrame(t).T
-    df = df.set_index('datetime')
-    df.index = pd.to_datetime(df.index)
-
-
-
-    df = df.groupby(pd.Grouper(freq='h')).sum()
-
+    # Sightings of each bike (a bike listed twice in a snapshot is one sighting), sorted by bike then time,
+    # and the bdf row of each
+    keys, rows = np.unique(bike.astype(np.int64) * n_snapshots + snapshot, return_index=True)
+    bike, snapshot = keys // n_snapshots, keys % n_snapshots
+    
+    # A bike left on a trip after a snapshot it isn't in the next one of, and came back in a snapshot
+    # it isn't in the previous one of
+    consecutive = (bike[1:] == bike[:-1]) & (snapshot[1:] == snapshot[:-1] + 1)
+    left = np.ones(len(keys), dtype=bool)
+    left[:-1] = ~consecutive
+    left &= snapshot < n_snapshots - 1
+    returned = np.ones(len(keys), dtype=bool)
+    returned[1:] = ~consecutive
+    returned &= snapshot > 0
+    trips = np.bincount(snapshot[left], minlength=n_snapshots)[:-1]
+    returns = np.bincount(snapshot[returned] - 1, minlength=n_snapshots)[:-1]
+    n_bikes = np.bincount(snapshot, minlength=n_snapshots).max()
+    
+    # Most bikes are parked, only compute distances for the ones that moved
+    lat = bdf['lat'].values.astype(float)[rows]
+    lon = bdf['lon'].values.astype(float)[rows]
+    moved = np.flatnonzero((bike[1:] == bike[:-1]) & ((lat[1:] != lat[:-1]) | (lon[1:] != lon[:-1])))
+    moved_distance = np.nan_to_num(_haversine(lat[moved], lon[moved], lat[moved + 1], lon[moved + 1]))
+    distance = np.bincount(snapshot[moved], weights=moved_distance, minlength=n_snapshots)[:-1]
+    
+    # Sum by hour of the earlier snapshot, every hour from the first to the second last snapshot
+    t = snapshot_times
+    hour = (t - t[0] // HOUR_NS * HOUR_NS) // HOUR_NS
+    n_hours = hour[-2] + 1
+    
+    hours = pd.DatetimeIndex((t[0] // HOUR_NS + np.arange(n_hours)) * HOUR_NS)
+    if times.tz is not None:
+        hours = hours.tz_localize('UTC').tz_convert(times.tz)
+    
+    df = pd.DataFrame({'datetime':hours,
+                       'trips':np.bincount(hour[:-1], weights=trips, minlength=n_hours).astype(np.int64),
+                       'returns':np.bincount(hour[:-1], weights=returns, minlength=n_hours).astype(np.int64),
+                       'distance':np.bincount(hour[:-1], weights=distance, minlength=n_hours).round().astype(np.int64)})
     df['station_id'] = 'free_bikes'
     df['num_bikes_available'] = n_bikes
-                
-    df = df.reset_index()
     
     return df
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    # Distance in metres between points in degrees
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    return 2 * 6371000 * np.arcsin(np.sqrt(a))
                 
                 
 def update_stations(system, session):
@@ -249,27 +754,16 @@ def update_stations(system, session):
     logger.info(f"{system.name} Station Update")
     
     
-    #Add a "free_bikes" station if it doesn't exist
-    fb_stations = session.query(Station).join(System).filter(System.id==system.id,Station.station_id=='free_bikes').all()
-    if len(fb_stations) == 0:
+    #Add a "free_bikes" station if it doesn't exist (the unique station index keeps it from being added twice,
+    # br-manager.py --migrate merges the duplicates of older databases)
+    fb_station = session.query(Station).join(System).filter(System.id==system.id,Station.station_id=='free_bikes').first()
+    if fb_station is None:
         fb_station = Station(name='free_bikes',station_id='free_bikes', system_id=system.id)
         session.add(fb_station)
             
         session.commit()
         logger.info(f"{system.name} add free_bikes station")
     
-    # If there's more than one fb station for a system, delete extras and assign trips to first instance
-    elif len(fb_stations) > 1:
-        fb_station = fb_stations[0]
-        ms = session.query(Measurement).join(Station).filter(Station.id.in_( [fb_station.id for fb_station in fb_stations])).all()
-        for m in ms:
-            m.station_id = fb_station.id
-
-        for fb_station in fb_stations[1:]:
-            session.delete(fb_station)
-        session.commit()
-        logger.info(f"{system.name} removed extra free_bikes stations")
-    
     
     
     try:
@@ -292,6 +786,8 @@ def update_stations(system, session):
     station_objs_ids = [x.station_id for x in station_objs]
     
     # Run through station info data to find new stations
+    renamed = False
+    sdf = sdf.drop_duplicates('station_id')  # station_id is unique within a system
     for station in sdf.to_dict('records'):
         # If station doesn't exist, create it
         if station['station_id'] not in station_objs_ids:
@@ -302,6 +798,8 @@ def update_stations(system, session):
             station_obj = [x for x in station_objs if x.station_id == station['station_id']][0]
             
             if (station_obj.name != station['name']) or (station_obj.lat != station['lat']) or (station_obj.lon != station['lon']):
+                if station_obj.name != station['name']:
+                    renamed = True
                 station_obj.name = station['name']
                 station_obj.lat = station['lat']
                 station_obj.lon = station['lon']
@@ -330,6 +828,9 @@ def update_stations(system, session):
             station_obj.active = False
             session.add(station_obj)
             
+    # Station names are part of activity responses
+    if renamed:
+        log_measurement_update(system, session)
 
     session.commit()
     logger.info(f"{system.name} Station Update Complete")
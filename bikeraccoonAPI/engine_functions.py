@@ -0,0 +1,55 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# Applied to every sqlite connection, in this order. busy_timeout comes first so the others wait for locks
+SQLITE_PRAGMAS = {
+    'busy_timeout':30000,  # ms to wait for a lock before failing with "database is locked"
+    'journal_mode':'wal',  # readers don't block the writer and the writer doesn't block readers
+    'synchronous':'normal',  # safe with WAL, only syncs at checkpoints instead of every commit
+    'cache_size':-65536,  # KiB of page cache per connection
+    'mmap_size':2**28,
+    'temp_store':'memory',
+}
+
+# Connections kept open by the API for reading, with up to READ_POOL_OVERFLOW more under load
+READ_POOL_SIZE = 8
+READ_POOL_OVERFLOW = 8
+
+
+def make_engine(url, readonly=False, pragmas=None, **kwargs):
+    """
+    Engine for a bikeraccoon sqlite db with SQLITE_PRAGMAS (updated with pragmas) set on every connection.
+
+    readonly=True gives a pool of READ_POOL_SIZE query_only connections, for the API. Otherwise the engine
+    has a single connection, for the tracker: sqlite only has one writer at a time anyway, and keeping the
+    connection open keeps its page cache. Sessions on a writer engine can't nest, a second one waits
+    for the first to close.
+
+    Other databases and in memory sqlite get a plain create_engine(url, **kwargs).
+    """
+    url = make_url(url)
+    if url.drivername != 'sqlite' or url.database in (None, '', ':memory:'):
+        return create_engine(url, **kwargs)
+
+    pragmas = {**SQLITE_PRAGMAS, **(pragmas or {})}
+    if readonly:
+        pragmas['query_only'] = 1
+        pool = {'pool_size':READ_POOL_SIZE, 'max_overflow':READ_POOL_OVERFLOW}
+    else:
+        pool = {'pool_size':1, 'max_overflow':0}
+
+    kwargs = {**kwargs, 'poolclass':QueuePool, **pool}
+    # Pooled connections are handed to whichever thread needs one next
+    kwargs['connect_args'] = {**kwargs.get('connect_args', {}), 'check_same_thread':False}
+    engine = create_engine(url, **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"pragma {name} = {value}")
+        cursor.close()
+
+    return engine
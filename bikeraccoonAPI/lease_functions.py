@@ -0,0 +1,127 @@
+import os
+import math
+import socket
+import datetime as dt
+
+from sqlalchemy import text, bindparam, DateTime
+
+from .models import System, SystemLease, TrackerWorker
+
+import logging
+logger = logging.getLogger("Rotating Log")
+
+
+# Several tracker processes (workers) can share the tracked systems. Each worker holds a lease on the
+# systems it polls and renews it with a heartbeat. Leases are only claimed once they have expired, so
+# a system is polled by one worker at a time and the systems of a worker that stops are taken over
+# after lease_ttl. Times are UTC from the workers' clocks, which should agree to well within lease_ttl.
+
+# Takes a system unless another worker holds a lease on it that hasn't expired (sqlite >= 3.24 or postgres)
+CLAIM_LEASE = text("""
+    insert into system_lease (system_id, worker, acquired, expires)
+    values (:system_id, :worker, :now, :expires)
+    on conflict (system_id) do update
+    set worker = excluded.worker, acquired = excluded.acquired, expires = excluded.expires
+    where system_lease.expires < excluded.acquired
+    """).bindparams(bindparam('now', type_=DateTime), bindparam('expires', type_=DateTime))
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def heartbeat(session, worker, ttl):
+    """
+    Record that worker is alive and renew its leases for ttl seconds, forgets workers that died over a day ago.
+    Returns the ids of the systems it holds.
+    """
+    now = dt.datetime.utcnow()
+    expires = now + dt.timedelta(seconds=ttl)
+
+    row = session.query(TrackerWorker).get(worker)
+    if row is None:
+        row = TrackerWorker(name=worker, started=now)
+        session.add(row)
+    row.heartbeat = now
+    row.expires = expires
+
+    session.query(TrackerWorker).filter(TrackerWorker.expires < now - dt.timedelta(days=1)).delete(synchronize_session=False)
+    
+    # Another worker can only have taken a lease by changing its worker, so renewing by worker is safe
+    session.query(SystemLease).filter(SystemLease.worker==worker).update({'expires':expires}, synchronize_session=False)
+    session.commit()
+    return {x for x, in session.query(SystemLease.system_id).filter(SystemLease.worker==worker)}
+
+def renew_lease(session, worker, system_id, ttl):
+    """
+    Renew one lease, returns False if worker no longer holds it
+    """
+    expires = dt.datetime.utcnow() + dt.timedelta(seconds=ttl)
+    qry = session.query(SystemLease).filter(SystemLease.system_id==system_id, SystemLease.worker==worker)
+    n = qry.update({'expires':expires}, synchronize_session=False)
+    session.commit()
+    return n == 1
+
+def fair_share(session, n_systems):
+    """
+    Number of systems each live worker should hold
+    """
+    now = dt.datetime.utcnow()
+    n_workers = session.query(TrackerWorker).filter(TrackerWorker.expires >= now).count()
+    return math.ceil(n_systems / max(n_workers, 1))
+
+def claim_systems(session, worker, system_ids, ttl, limit):
+    """
+    Claim up to limit of the systems in system_ids that aren't held by a live worker.
+    Returns the ids of the systems claimed.
+    """
+    now = dt.datetime.utcnow()
+    expires = now + dt.timedelta(seconds=ttl)
+
+    claimed = set()
+    for system_id in system_ids:
+        if len(claimed) >= limit:
+            break
+        session.execute(CLAIM_LEASE, {'system_id':system_id, 'worker':worker, 'now':now, 'expires':expires})
+        session.commit()
+        owner = session.query(SystemLease.worker).filter(SystemLease.system_id==system_id).scalar()
+        if owner == worker:
+            claimed.add(system_id)
+    return claimed
+
+def release_systems(session, worker, system_ids):
+    if len(system_ids) == 0:
+        return
+    qry = session.query(SystemLease).filter(SystemLease.worker==worker, SystemLease.system_id.in_(list(system_ids)))
+    qry.delete(synchronize_session=False)
+    session.commit()
+
+def release_worker(session, worker):
+    """
+    Give up all of a worker's leases, so that other workers take over its systems straight away
+    """
+    session.query(SystemLease).filter(SystemLease.worker==worker).delete(synchronize_session=False)
+    session.query(TrackerWorker).filter(TrackerWorker.name==worker).delete(synchronize_session=False)
+    session.commit()
+
+def lease_status(session):
+    """
+    Returns (workers, leases): [{worker, started, heartbeat, alive, systems}] and
+    [{system, worker, acquired, expires, alive}] of every tracked or leased system
+    """
+    now = dt.datetime.utcnow()
+    leases = {x.system_id:x for x in session.query(SystemLease)}
+
+    rows = []
+    for system in session.query(System).order_by(System.name):
+        lease = leases.get(system.id)
+        if lease is None and not system.is_tracking:
+            continue
+        rows.append({'system':system.name, 'worker':lease.worker if lease is not None else None,
+                     'acquired':lease.acquired if lease is not None else None,
+                     'expires':lease.expires if lease is not None else None,
+                     'alive':lease is not None and lease.expires >= now})
+
+    workers = [{'worker':x.name, 'started':x.started, 'heartbeat':x.heartbeat, 'alive':x.expires >= now,
+                'systems':sum(1 for r in rows if r['worker'] == x.name)}
+               for x in session.query(TrackerWorker).order_by(TrackerWorker.name)]
+    return workers, rows
@@ -0,0 +1,161 @@
+import os
+import math
+import bisect
+import threading
+
+
+class Registry:
+    """
+    A set of metrics that are rendered together in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+    def write_textfile(self, path):
+        # Written atomically, for the node_exporter textfile collector or the API's /metrics
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values: value
+        self.lock = threading.Lock()
+        if registry is not None:
+            registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k,v in pairs) + '}'
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines += self._samples(key, value)
+        return '\n'.join(lines) + '\n'
+
+    def _samples(self, key, value):
+        return [f"{self.name}{self._labels(key)} {_number(value)}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = sorted(buckets or LATENCY_BUCKETS)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, n = self.values.get(key, ([0]*len(self.buckets), 0, 0))
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            self.values[key] = (counts, total + value, n + 1)
+
+    def _samples(self, key, value):
+        counts, total, n = value
+        # Prometheus buckets are cumulative, the +Inf bucket is the count
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._labels(key, [('le', _number(bound))])} {cumulative}")
+        lines.append(f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {n}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._labels(key)} {n}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+SIZE_BUCKETS = [2**x for x in range(8, 28, 2)]  # 256 bytes to 64MB
+COUNT_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+
+## API metrics, served by /metrics
+
+api_registry = Registry()
+
+request_latency = Histogram('bikeraccoon_http_request_duration_seconds', 'Time to handle a request',
+                            ['route', 'method', 'status'], api_registry)
+response_size = Histogram('bikeraccoon_http_response_size_bytes', 'Size of response bodies as sent, streamed responses are not counted',
+                          ['route'], api_registry, SIZE_BUCKETS)
+db_queries = Histogram('bikeraccoon_db_queries_per_request', 'DB queries executed while handling a request',
+                       ['route'], api_registry, COUNT_BUCKETS)
+db_query_duration = Histogram('bikeraccoon_db_query_duration_seconds', 'Duration of DB queries',
+                              ['route'], api_registry)
+
+
+## Tracker metrics, written to a textfile by the tracker
+
+tracker_registry = Registry()
+
+fetch_latency = Histogram('bikeraccoon_tracker_fetch_seconds', 'Time to download and decode a GBFS feed',
+                          ['system', 'feed'], tracker_registry)
+parse_time = Histogram('bikeraccoon_tracker_parse_seconds', 'Time to turn a GBFS feed into a snapshot',
+                       ['system', 'feed'], tracker_registry)
+polls = Counter('bikeraccoon_tracker_polls_total', 'Feed polls by outcome (processed, skipped when unchanged, failed)',
+                ['system', 'feed', 'outcome'], tracker_registry)
+rows_written = Counter('bikeraccoon_tracker_rows_written_total', 'Rows written by the tracker',
+                       ['system', 'table'], tracker_registry)
+update_duration = Histogram('bikeraccoon_tracker_update_trips_seconds', 'Time to compute and save trips for a system',
+                            ['system'], tracker_registry)
+loop_lag = Gauge('bikeraccoon_tracker_loop_lag_seconds', 'How late the latest batch of due jobs started compared to its schedule',
+                 [], tracker_registry)
+loop_duration = Gauge('bikeraccoon_tracker_loop_seconds', 'Time to run the latest batch of due jobs',
+                      [], tracker_registry)
+query_interval = Gauge('bikeraccoon_tracker_query_interval_seconds', 'Time between polls of each system, from its feed ttl',
+                       ['system'], tracker_registry)
+job_next_run = Gauge('bikeraccoon_tracker_job_next_run_timestamp_seconds', 'When each scheduled job runs next (unix time)',
+                     ['system', 'job'], tracker_registry)
+job_lateness = Gauge('bikeraccoon_tracker_job_lateness_seconds', 'How late the latest run of each scheduled job started',
+                     ['system', 'job'], tracker_registry)
+job_failures = Gauge('bikeraccoon_tracker_job_failures', 'Consecutive failed runs of each scheduled job',
+                     ['system', 'job'], tracker_registry)
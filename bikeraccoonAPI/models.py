@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, ForeignKey, String, DateTime, Float, Boolean
+from sqlalchemy import Table, Column, Integer, ForeignKey, String, DateTime, Float, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 import datetime as dt
@@ -42,10 +42,12 @@ class Station(Base):
     lat = Column('lat', Float)
     lon = Column('lon', Float)
     active = Column('active',Boolean)
-    system_id = Column(Integer, ForeignKey('system.id'), index=True)
+    system_id = Column(Integer, ForeignKey('system.id'))
     system = relationship("System", back_populates='stations')
     measurements = relationship("Measurement", back_populates='station')
     
+    __table_args__ = (Index('ix_station_system_station', 'system_id', 'station_id', unique=True),)
+    
     def __repr__(self):
         return f"<Station: name={self.name} system={self.system.name}>"
     
@@ -59,14 +61,23 @@ class Station(Base):
 class Measurement(Base):
     __tablename__ = 'measurement'
     id = Column(Integer, primary_key=True)
-    datetime = Column('datetime',DateTime, index=True)
+    datetime = Column('datetime',DateTime)
     trips = Column('trips',Integer)
     returns = Column('returns',Integer)
     num_bikes_available = Column('num_bikes_available',Integer)
     num_docks_available = Column('num_docks_available',Integer)
-    station_id = Column('station_id',Integer, ForeignKey('station.id'), index=True)
+    distance = Column('distance',Integer) # metres free bikes moved in the hour, free_bikes station only
+    station_id = Column('station_id',Integer, ForeignKey('station.id'))
     station = relationship("Station", back_populates='measurements')
     
+    # One row per station and hour, update_trips adds to existing rows with INSERT ... ON CONFLICT, which needs
+    # a unique index on exactly (station_id, datetime). The API reads a system's stations over a time range
+    # from the second index alone, sqlite has no INCLUDE so the values it reads are trailing columns.
+    # Every query on datetime also has station_id, so there is no index on datetime alone.
+    __table_args__ = (Index('ix_measurement_station_datetime', 'station_id', 'datetime', unique=True),
+                      Index('ix_measurement_station_datetime_values', 'station_id', 'datetime', 'trips', 'returns',
+                            'num_bikes_available', 'num_docks_available'),)
+    
     def __repr__(self):
         return f"<Measurement: {self.station.system.name} {self.station.name} {self.datetime}>"
     
@@ -79,6 +90,117 @@ class Measurement(Base):
         return r
     
     
+# Rollups hold Measurement data pre-aggregated by local day ('d'), month ('m') and year ('y')
+# They are maintained by update_trips and can be rebuilt with br-manager.py --rollup
+
+class StationRollup(Base):
+    __tablename__ = 'station_rollup'
+    __table_args__ = (UniqueConstraint('station_id','frequency','datetime'),
+                      Index('ix_station_rollup_station_first_values', 'station_id', 'frequency', 'first_datetime',
+                            'trips', 'returns', 'num_bikes_total', 'num_docks_total', 'n_measurements'),)
+    id = Column(Integer, primary_key=True)
+    frequency = Column('frequency',String)
+    datetime = Column('datetime',DateTime) # start of period in system local time
+    first_datetime = Column('first_datetime',DateTime, index=True) # earliest measurement in period, UTC
+    trips = Column('trips',Integer)
+    returns = Column('returns',Integer)
+    num_bikes_total = Column('num_bikes_total',Integer) # used with n_measurements to compute means
+    num_docks_total = Column('num_docks_total',Integer)
+    n_measurements = Column('n_measurements',Integer)
+    station_id = Column('station_id',Integer, ForeignKey('station.id'))
+    station = relationship("Station")
+    
+    def __repr__(self):
+        return f"<StationRollup: {self.station.name} {self.frequency} {self.datetime}>"
+    
+class SystemRollup(Base):
+    __tablename__ = 'system_rollup'
+    __table_args__ = (UniqueConstraint('system_id','frequency','datetime'),
+                      Index('ix_system_rollup_system_first_values', 'system_id', 'frequency', 'first_datetime',
+                            'trips', 'free_bike_trips', 'free_bike_measurements'),)
+    id = Column(Integer, primary_key=True)
+    frequency = Column('frequency',String)
+    datetime = Column('datetime',DateTime) # start of period in system local time
+    first_datetime = Column('first_datetime',DateTime, index=True) # earliest measurement in period, UTC
+    trips = Column('trips',Integer) # all stations, including free bikes
+    returns = Column('returns',Integer)
+    free_bike_trips = Column('free_bike_trips',Integer)
+    free_bike_returns = Column('free_bike_returns',Integer)
+    free_bike_measurements = Column('free_bike_measurements',Integer)
+    system_id = Column('system_id',Integer, ForeignKey('system.id'))
+    system = relationship("System")
+    
+    def __repr__(self):
+        return f"<SystemRollup: {self.system.name} {self.frequency} {self.datetime}>"
+    
+    
+
+# Latest MeasurementUpdate rows kept per system, older ones are deleted as new ones are logged
+MEASUREMENT_UPDATES_KEPT = 1000
+
+class MeasurementUpdate(Base):
+    """
+    Log of the measurement hours written by each update_trips commit, used to invalidate cached API responses
+    """
+    __tablename__ = 'measurement_update'
+    id = Column(Integer, primary_key=True)
+    datetime = Column('datetime',DateTime, default=dt.datetime.utcnow)
+    first_datetime = Column('first_datetime',DateTime)
+    last_datetime = Column('last_datetime',DateTime)
+    system_id = Column('system_id', Integer, ForeignKey('system.id'), index=True)
+    system = relationship('System')
+    
+    def __repr__(self):
+        return f"<MeasurementUpdate: {self.system.name} {self.first_datetime} {self.last_datetime}>"
+    
+    
+class MeasurementArchive(Base):
+    """
+    A month (UTC) of a system's measurements moved out of the measurement table into a Parquet file,
+    see archive_functions.py
+    """
+    __tablename__ = 'measurement_archive'
+    __table_args__ = (UniqueConstraint('system_id','month'),)
+    id = Column(Integer, primary_key=True)
+    month = Column('month',DateTime)
+    first_datetime = Column('first_datetime',DateTime) # earliest and latest measurement in the file
+    last_datetime = Column('last_datetime',DateTime)
+    rows = Column('rows',Integer)
+    path = Column('path',String)
+    archived = Column('archived',DateTime, default=dt.datetime.utcnow)
+    system_id = Column('system_id', Integer, ForeignKey('system.id'))
+    system = relationship('System')
+    
+    def __repr__(self):
+        return f"<MeasurementArchive: {self.system.name} {self.month:%Y-%m} {self.path}>"
+    
+    
+# Tracker workers share the tracked systems through leases, see lease_functions.py
+
+class TrackerWorker(Base):
+    __tablename__ = 'tracker_worker'
+    name = Column('name',String, primary_key=True)
+    started = Column('started',DateTime)
+    heartbeat = Column('heartbeat',DateTime)
+    expires = Column('expires',DateTime) # considered dead after this, UTC
+    
+    def __repr__(self):
+        return f"<TrackerWorker: {self.name} {self.heartbeat}>"
+
+class SystemLease(Base):
+    """
+    The worker that polls a system. A lease that isn't renewed before it expires can be claimed by another worker
+    """
+    __tablename__ = 'system_lease'
+    system_id = Column('system_id', Integer, ForeignKey('system.id'), primary_key=True)
+    worker = Column('worker',String, index=True)
+    acquired = Column('acquired',DateTime)
+    expires = Column('expires',DateTime) # UTC
+    system = relationship('System')
+    
+    def __repr__(self):
+        return f"<SystemLease: {self.system.name} {self.worker} {self.expires}>"
+    
     
 class Trip(Base):
     __tablename__ = 'trip'
@@ -1,45 +1,163 @@
 import pandas as pd
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import datetime as dt
-import timeout_decorator
+import time
+import threading
 import ssl
 
 import logging
 logger = logging.getLogger("Rotating Log")
 
+# Shared by the tracker's fetch threads so connections to each feed host are reused.
+# Timeouts are (connect, read) in seconds, which unlike signal based timeouts work outside the main thread
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+http_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+REQUEST_TIMEOUT = (10, 20)
+
+def get_json(url):
+    r = http_session.get(url, timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+
+# Feed maps from each system's gbfs.json, keyed by System.url. Feed urls almost never change
+# and a stale map is refreshed as soon as a feed fails to load, so the GBFS ttl is only
+# honoured when it's longer than DISCOVERY_MIN_TTL (seconds)
+DISCOVERY_MIN_TTL = 3600
+discovery_cache = {}
+discovery_stats = {'requests':0, 'avoided':0}
+_discovery_lock = threading.Lock()
+
+def get_feed_urls(sys_url):
+    """
+    Returns {feed name: url} from the system's gbfs.json, downloading it only if the cached copy has expired
+    """
+    with _discovery_lock:
+        feeds, expires = discovery_cache.get(sys_url, (None, 0))
+        if time.time() < expires:
+            discovery_stats['avoided'] += 1
+            return feeds
+        discovery_stats['requests'] += 1
+    
+    data = get_json(sys_url)
+    feeds = {x['name']:x['url'] for x in data['data']['en']['feeds']}
+    ttl = max(data.get('ttl', 0), DISCOVERY_MIN_TTL)
+    
+    with _discovery_lock:
+        discovery_cache[sys_url] = (feeds, time.time() + ttl)
+    return feeds
+
+def refresh_feed_urls(sys_url):
+    with _discovery_lock:
+        discovery_cache.pop(sys_url, None)
+    return get_feed_urls(sys_url)
+
+def query_feed(sys_url, name, conditional=False):
+    """
+    Download and parse a GBFS feed. If it fails to load (eg. 404 or bad json) the system's
+    gbfs.json is downloaded again and the feed retried once.
+    Raises KeyError if the system doesn't publish the feed.
+    With conditional=True, raises FeedNotModified if the feed hasn't changed since the last conditional query.
+    """
+    url = get_feed_urls(sys_url)[name]
+    try:
+        return get_feed(url, conditional)
+    except (requests.HTTPError, ValueError):
+        logger.debug(f"{sys_url} {name} failed to load, refreshing gbfs.json")
+        return get_feed(refresh_feed_urls(sys_url)[name], conditional)
+    
+    
+class FeedNotModified(Exception):
+    pass
+
+# State of conditional queries for each feed url: etag, last_modified, last_updated, ttl and expires.
+# Fetch threads and the tracker's scheduler share it, entries are replaced rather than changed.
+feed_state = {}
+_feed_state_lock = threading.Lock()
+
+def get_feed(url, conditional=False):
+    """
+    Download a feed. Conditional queries skip the request while the feed is within its ttl,
+    send If-None-Match/If-Modified-Since when the server gave an ETag/Last-Modified, and
+    raise FeedNotModified on a 304 or when last_updated is unchanged.
+    """
+    if not conditional:
+        return get_json(url)
+    
+    now = time.time()
+    with _feed_state_lock:
+        state = feed_state.get(url, {})
+    if now < state.get('expires', 0):
+        raise FeedNotModified(f"{url} within ttl")
+    
+    headers = {}
+    if 'etag' in state:
+        headers['If-None-Match'] = state['etag']
+    if 'last_modified' in state:
+        headers['If-Modified-Since'] = state['last_modified']
+        
+    r = http_session.get(url, timeout=REQUEST_TIMEOUT, headers=headers)
+    if r.status_code == 304:
+        with _feed_state_lock:
+            feed_state[url] = {**state, 'expires':now + state.get('ttl', 0)}
+        raise FeedNotModified(f"{url} 304")
+    r.raise_for_status()
+    data = r.json()
+    
+    ttl = data.get('ttl', 0)
+    last_updated = data.get('last_updated')
+    expires = now + ttl
+    if last_updated is not None:
+        expires = min(expires, last_updated + ttl)  # ttl counts from last_updated
+    with _feed_state_lock:
+        feed_state[url] = {k:v for k,v in {'etag':r.headers.get('ETag'), 'last_modified':r.headers.get('Last-Modified'),
+                                           'last_updated':last_updated, 'ttl':ttl, 'expires':expires}.items()
+                           if v is not None}
+    
+    if last_updated is not None and last_updated == state.get('last_updated'):
+        raise FeedNotModified(f"{url} last_updated unchanged")
+    return data
+
+def feed_ttl(sys_url, names=('station_status', 'free_bike_status')):
+    """
+    Shortest ttl (seconds) of the system's feeds from their last conditional query, None if none have been queried
+    """
+    with _discovery_lock:
+        feeds, _ = discovery_cache.get(sys_url, ({}, 0))
+    with _feed_state_lock:
+        states = [feed_state.get(feeds[x], {}) for x in names if x in feeds]
+    ttls = [state['ttl'] for state in states if 'ttl' in state]
+    return min(ttls) if len(ttls) > 0 else None
+
 def get_station_status_url(sys_url):
-    data = requests.get(sys_url).json()
-    return [x for x in data['data']['en']['feeds'] if x['name']=='station_status'][0]['url']      
+    return get_feed_urls(sys_url)['station_status']
 
 def get_station_info_url(sys_url):
-    data = requests.get(sys_url).json()
-    return [x for x in data['data']['en']['feeds'] if x['name']=='station_information'][0]['url']   
+    return get_feed_urls(sys_url)['station_information']
 
 
 def get_system_info_url(sys_url):
-    data = requests.get(sys_url).json()
-    return [x for x in data['data']['en']['feeds'] if x['name']=='system_information'][0]['url']
+    return get_feed_urls(sys_url)['system_information']
 
-@timeout_decorator.timeout(30) 
 def query_system_info(sys_url):
-    url = get_system_info_url(sys_url)
 
-    data = requests.get(url).json()
+    data = query_feed(sys_url, 'system_information')
 
     return data
 
     
-@timeout_decorator.timeout(30) 
-def query_station_status(sys_url):
+def query_station_status(sys_url, conditional=False, timings=None):
     """
-    Query station_status.json
+    Query station_status.json. If timings is a dict, the seconds spent downloading ('fetch')
+    and parsing ('parse') the feed are added to it.
     """
     
-    url = get_station_status_url(sys_url)
-
-
-    data = requests.get(url).json()
+    start = time.perf_counter()
+    data = query_feed(sys_url, 'station_status', conditional)
+    fetched = time.perf_counter()
 
     try:
         df = pd.DataFrame(data['data']['stations'])
@@ -57,18 +175,16 @@ def query_station_status(sys_url):
     
     df = df[['datetime','num_bikes_available','num_docks_available','is_renting','station_id']]
 
-
+    if timings is not None:
+        timings.update({'fetch':fetched - start, 'parse':time.perf_counter() - fetched})
     return df
 
-@timeout_decorator.timeout(30) 
 def query_station_info(sys_url):
     
     """
     Query station_information.json
     """
-    url = get_station_info_url(sys_url)
-
-    data = requests.get(url).json()
+    data = query_feed(sys_url, 'station_information')
 
     try:
         df =  pd.DataFrame(data['data']['stations'])
@@ -76,16 +192,15 @@ def query_station_info(sys_url):
         df =  pd.DataFrame(data['stations'])
     return df[['name','station_id','lat','lon']]
 
-@timeout_decorator.timeout(30) 
-def query_free_bikes(sys_url):
+def query_free_bikes(sys_url, conditional=False, timings=None):
     
     """
-    Query free_bikes.json
+    Query free_bikes.json, see query_station_status for timings
     """
     
-    url = get_free_bike_url(sys_url)
-
-    data = requests.get(url).json()
+    start = time.perf_counter()
+    data = query_feed(sys_url, 'free_bike_status', conditional)
+    fetched = time.perf_counter()
 
     try:    
         df = pd.DataFrame(data['data']['bikes'])
@@ -105,9 +220,10 @@ def query_free_bikes(sys_url):
     
     df = df[['bike_id','lat','lon','datetime']]
 
+    if timings is not None:
+        timings.update({'fetch':fetched - start, 'parse':time.perf_counter() - fetched})
     return df
 
     
 def get_free_bike_url(sys_url):
-    data = requests.get(sys_url).json()
-    return [x for x in data['data']['en']['feeds'] if x['name']=='free_bike_status'][0]['url']
\ No newline at end of file
+    return get_feed_urls(sys_url)['free_bike_status']
@@ -0,0 +1,139 @@
+import time
+import heapq
+import random
+import itertools
+import datetime as dt
+
+from .tz_functions import get_tz
+
+
+class Job:
+    """
+    A recurring job for one system (or for the tracker itself when system is None).
+    due is when it should run next, started is when its current run started (None when idle).
+    """
+
+    def __init__(self, system, kind, interval):
+        self.system = system
+        self.kind = kind
+        self.interval = interval
+        self.due = None
+        self.started = None
+        self.lateness = 0
+        self.failures = 0
+        self.last_run = None
+
+    @property
+    def key(self):
+        return (self.system, self.kind)
+
+
+class Scheduler:
+    """
+    Priority queue of jobs by due time (unix seconds). Rescheduling a job leaves its old
+    heap entry behind, entries that don't match the job's current due time are skipped.
+    """
+
+    def __init__(self, jitter=0.1, max_backoff=600):
+        self.jobs = {}
+        self.queue = []
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self._seq = itertools.count()
+
+    def add(self, job, due):
+        self.jobs[job.key] = job
+        self.schedule(job, due)
+        return job
+
+    def remove(self, key):
+        # Its heap entry is skipped once the job is gone
+        return self.jobs.pop(key, None)
+
+    def schedule(self, job, due):
+        job.due = due
+        heapq.heappush(self.queue, (due, next(self._seq), job.key))
+
+    def _peek(self):
+        while self.queue:
+            due, _, key = self.queue[0]
+            job = self.jobs.get(key)
+            if job is not None and job.due == due and job.started is None:
+                return job
+            heapq.heappop(self.queue)
+        return None
+
+    def next_due(self):
+        job = self._peek()
+        return job.due if job is not None else None
+
+    def pop_due(self, now=None):
+        """
+        Returns the jobs that are due, marked as started, in due order
+        """
+        now = time.time() if now is None else now
+        jobs = []
+        job = self._peek()
+        while job is not None and job.due <= now:
+            heapq.heappop(self.queue)
+            job.started = now
+            job.lateness = now - job.due
+            jobs.append(job)
+            job = self._peek()
+        return jobs
+
+    def done(self, job, ok=True, interval=None, due=None, now=None):
+        """
+        Reschedule a job after a run. Runs stay on the job's original schedule (so jobs keep the
+        random start spread() gave them) unless they fell behind by a whole interval, then the missed
+        runs are skipped. Failed runs back off exponentially with jitter, up to max_backoff seconds.
+        A successful run can set its next due time instead.
+        """
+        now = time.time() if now is None else now
+        if interval is not None:
+            job.interval = interval
+        job.started = None
+        job.last_run = now
+        if job.key not in self.jobs:
+            return
+
+        if ok:
+            job.failures = 0
+            if due is None:
+                due = max(job.due + job.interval, now)
+        else:
+            job.failures += 1
+            backoff = min(job.interval * 2**job.failures, self.max_backoff)
+            due = now + backoff * (1 - self.jitter * random.random())
+        self.schedule(job, due)
+
+    def spread(self, interval, start=None):
+        # Random time within interval of start (default now), so jobs added together don't all run together
+        start = time.time() if start is None else start
+        return start + random.uniform(0, interval)
+
+    def status(self):
+        """
+        List of {system, job, next_run, interval, lateness, failures, running}, ordered by next_run
+        """
+        rows = [{'system':job.system, 'job':job.kind,
+                 'next_run':dt.datetime.fromtimestamp(job.due) if job.started is None else None,
+                 'interval':job.interval, 'lateness':job.lateness, 'failures':job.failures,
+                 'running':job.started is not None}
+                for job in self.jobs.values()]
+        return sorted(rows, key=lambda x: (x['next_run'] is None, x['next_run'] or dt.datetime.min))
+
+
+def next_local_hour(tz, hour, now=None):
+    """
+    Unix time of the next time it's hour o'clock in timezone tz
+    """
+    tz = get_tz(tz)
+    now = time.time() if now is None else now
+    local = dt.datetime.fromtimestamp(now, tz)
+    day = local.date()
+    while True:
+        t = tz.localize(dt.datetime.combine(day, dt.time(hour))).timestamp()
+        if t > now:
+            return t
+        day = day + dt.timedelta(days=1)
@@ -0,0 +1,224 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger("Rotating Log")
+
+
+# Fixed width columns of each snapshot kind. Missing ints are stored as -1.
+STATION_COLUMNS = {'datetime':'<i8', 'station':'<i4', 'num_bikes_available':'<i4',
+                   'num_docks_available':'<i4', 'is_renting':'i1'}
+BIKE_COLUMNS = {'datetime':'<i8', 'bike':'<u8', 'lat':'<f8', 'lon':'<f8'}
+
+
+class SnapshotStore:
+    """
+    Append-only store of raw GBFS snapshots, an alternative to the {system}_stations_raw and
+    {system}_bikes_raw tables in the raw sqlite db.
+
+    Each column is a file of fixed width values, in one directory per system, kind ('stations' or 'bikes')
+    and UTC hour:
+
+        root/system/stations/2021123123/datetime.bin, station.bin, ...
+
+    Snapshots are appended to the files of their hour and read back through np.memmap. A rows file in each
+    hour holds the number of complete rows, written after every append, anything past it is left over from an
+    interrupted append and is cut off before the next one.
+    Station ids are stored as indexes into root/system/station_ids, bike ids as 64 bit hashes
+    (enough to tell bikes apart for make_free_bike_trips).
+    trim() marks everything before the latest snapshot as processed and deletes the hours before it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.station_ids = {}  # system: list of station_ids, position is the stored index
+        self.station_index = {}  # system: {station_id: index}
+
+    def append_stations(self, system_name, ddf):
+        """
+        Append a station_status snapshot (as returned by query_station_status)
+        """
+        index = self._station_index(system_name)
+        new = [x for x in pd.unique(ddf['station_id']) if x not in index]
+        if len(new) > 0:
+            with open(os.path.join(self.root, system_name, 'station_ids'), 'a') as f:
+                f.writelines(f"{x}\n" for x in new)
+            for x in new:
+                index[x] = len(self.station_ids[system_name])
+                self.station_ids[system_name].append(x)
+
+        columns = {'datetime':_to_ns(ddf['datetime']),
+                   'station':ddf['station_id'].map(index).values,
+                   'num_bikes_available':_fill(ddf['num_bikes_available']),
+                   'num_docks_available':_fill(ddf['num_docks_available']),
+                   'is_renting':_fill(ddf['is_renting'])}
+        self._append(system_name, 'stations', STATION_COLUMNS, columns)
+
+    def append_free_bikes(self, system_name, bdf):
+        """
+        Append a free_bike_status snapshot (as returned by query_free_bikes)
+        """
+        columns = {'datetime':_to_ns(bdf['datetime']),
+                   'bike':pd.util.hash_array(bdf['bike_id'].astype(str).values),
+                   'lat':bdf['lat'].values, 'lon':bdf['lon'].values}
+        self._append(system_name, 'bikes', BIKE_COLUMNS, columns)
+
+    def read_stations(self, system_name):
+        """
+        Unprocessed station snapshots, in the format of the {system}_stations_raw table
+        """
+        cols = self._read(system_name, 'stations', STATION_COLUMNS)
+        if cols is None:
+            return pd.DataFrame()
+
+        station_ids = np.array(self._station_ids(system_name), dtype=object)
+        df = pd.DataFrame({'datetime':pd.to_datetime(cols['datetime'], utc=True),
+                           'num_bikes_available':_unfill(cols['num_bikes_available']),
+                           'num_docks_available':_unfill(cols['num_docks_available']),
+                           'is_renting':_unfill(cols['is_renting']),
+                           'station_id':station_ids[cols['station']]})
+        return df
+
+    def read_free_bikes(self, system_name):
+        """
+        Unprocessed free bike snapshots, in the format of the {system}_bikes_raw table
+        """
+        cols = self._read(system_name, 'bikes', BIKE_COLUMNS)
+        if cols is None:
+            return pd.DataFrame()
+
+        return pd.DataFrame({'datetime':pd.to_datetime(cols['datetime'], utc=True),
+                             'bike_id':cols['bike'], 'lat':cols['lat'], 'lon':cols['lon']})
+
+    def trim(self, system_name):
+        """
+        Only keep the latest snapshot of each kind, drop older snapshots
+        """
+        for kind, columns in [('stations', STATION_COLUMNS), ('bikes', BIKE_COLUMNS)]:
+            cols = self._read(system_name, kind, columns)
+            if cols is None:
+                continue
+            start = int(cols['datetime'].max())
+            _write_marker(os.path.join(self.root, system_name, kind, 'start'), start)
+
+            start_hour = _hour(start)
+            for hour in self._hours(system_name, kind):
+                if hour < start_hour:
+                    shutil.rmtree(os.path.join(self.root, system_name, kind, hour))
+
+    def clear(self, system_name):
+        """
+        Drop all snapshots of a system, the next one appended starts from scratch
+        """
+        for kind in ('stations', 'bikes'):
+            path = os.path.join(self.root, system_name, kind)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def _append(self, system_name, kind, dtypes, columns):
+        n = len(columns['datetime'])
+        if n == 0:
+            return
+
+        # A snapshot has a single datetime, so it goes in one segment
+        path = os.path.join(self.root, system_name, kind, _hour(columns['datetime'][0]))
+        os.makedirs(path, exist_ok=True)
+        rows = _committed_rows(path, dtypes)
+        for name, dtype in dtypes.items():
+            with open(os.path.join(path, f"{name}.bin"), 'ab') as f:
+                f.truncate(rows * np.dtype(dtype).itemsize)
+                f.write(np.asarray(columns[name], dtype=dtype).tobytes())
+        _write_marker(os.path.join(path, 'rows'), rows + n)
+
+    def _read(self, system_name, kind, dtypes):
+        start = _read_marker(os.path.join(self.root, system_name, kind, 'start'))
+        segments = []
+        for hour in self._hours(system_name, kind):
+            if start is not None and hour < _hour(start):
+                continue
+            segment = self._read_segment(os.path.join(self.root, system_name, kind, hour), dtypes)
+            if segment is not None:
+                segments.append(segment)
+
+        if len(segments) == 0:
+            return None
+        if len(segments) == 1:
+            cols = segments[0]
+        else:
+            cols = {name:np.concatenate([s[name] for s in segments]) for name in dtypes}
+
+        if start is not None:
+            keep = cols['datetime'] >= start
+            if not keep.all():
+                cols = {name:x[keep] for name,x in cols.items()}
+        if len(cols['datetime']) == 0:
+            return None
+        return cols
+
+    def _read_segment(self, path, dtypes):
+        n = _committed_rows(path, dtypes)
+        if n == 0:
+            return None
+        return {name:np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode='r', shape=(n,))
+                for name, dtype in dtypes.items()}
+
+    def _hours(self, system_name, kind):
+        path = os.path.join(self.root, system_name, kind)
+        if not os.path.isdir(path):
+            return []
+        return sorted(x for x in os.listdir(path) if os.path.isdir(os.path.join(path, x)))
+
+    def _station_ids(self, system_name):
+        if system_name not in self.station_ids:
+            path = os.path.join(self.root, system_name, 'station_ids')
+            os.makedirs(os.path.join(self.root, system_name), exist_ok=True)
+            ids = []
+            if os.path.exists(path):
+                with open(path) as f:
+                    ids = f.read().splitlines()
+            self.station_ids[system_name] = ids
+            self.station_index[system_name] = {x:i for i,x in enumerate(ids)}
+        return self.station_ids[system_name]
+
+    def _station_index(self, system_name):
+        self._station_ids(system_name)
+        return self.station_index[system_name]
+
+
+def _to_ns(t):
+    return pd.to_datetime(t, utc=True).values.astype('datetime64[ns]').view('<i8')
+
+def _hour(ns):
+    return pd.Timestamp(int(ns)).strftime('%Y%m%d%H')
+
+def _fill(x):
+    return pd.to_numeric(x).fillna(-1).values
+
+def _unfill(x):
+    x = x.astype(float)
+    x[x < 0] = np.nan
+    return x
+
+def _committed_rows(path, dtypes):
+    # Rows past the count in the rows file are from an interrupted append. Segments written before
+    # there was a rows file use the shortest column.
+    sizes = []
+    for name, dtype in dtypes.items():
+        f = os.path.join(path, f"{name}.bin")
+        sizes.append(os.path.getsize(f) // np.dtype(dtype).itemsize if os.path.exists(f) else 0)
+    rows = _read_marker(os.path.join(path, 'rows'))
+    return min(sizes) if rows is None else min(sizes + [rows])
+
+def _read_marker(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(f.read())
+
+def _write_marker(path, value):
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(value))
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,188 @@
+import json
+import datetime as dt
+
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import logging
+logger = logging.getLogger("Rotating Log")
+
+
+class TripAccumulator:
+    """
+    Computes a system's hourly trips as snapshots arrive, instead of saving them to the raw tables
+    and reading them back in update_trips.
+
+    Station trips/returns are the changes in num_bikes_available between consecutive station_status
+    snapshots, free bike trips/returns are the bikes that disappear/appear between consecutive
+    free_bike_status snapshots. Both are counted in the hour of the earlier snapshot and
+    num_bikes_available/num_docks_available are the maximum seen since the last flush,
+    the same as make_station_trips and make_free_bike_trips.
+    """
+
+    def __init__(self, system_name):
+        self.system_name = system_name
+
+        self.stations = None        # (datetime, {station_id: (bikes, docks)}) of the last snapshot
+        self.bikes = None           # (datetime, set of bike_ids) of the last snapshot
+
+        self.station_trips = {}     # (hour, station_id): [trips, returns]
+        self.station_max = {}       # station_id: [bikes, docks]
+        self.free_bike_trips = {}   # hour: [trips, returns]
+        self.free_bike_max = 0
+
+    def add_stations(self, ddf):
+        """
+        Add a station_status snapshot (as returned by query_station_status)
+        """
+        if ddf is None or len(ddf) == 0:
+            return
+
+        t = ddf['datetime'].iloc[0]
+        if self.stations is not None and t <= self.stations[0]:
+            return
+
+        snapshot = {sid:(_value(b), _value(d)) for sid,b,d in zip(ddf['station_id'], ddf['num_bikes_available'], ddf['num_docks_available'])}
+
+        if self.stations is not None:
+            t0, previous = self.stations
+            hour = t0.floor('h')
+            for sid, (bikes, docks) in snapshot.items():
+                if sid not in previous or bikes is None or previous[sid][0] is None:
+                    continue
+                delta = bikes - previous[sid][0]
+                counts = self.station_trips.setdefault((hour, sid), [0, 0])
+                if delta > 0:
+                    counts[0] += delta   # Signs as in make_station_trips
+                else:
+                    counts[1] -= delta
+
+        hour = t.floor('h')
+        for sid, values in snapshot.items():
+            self.station_trips.setdefault((hour, sid), [0, 0])
+            self._update_station_max(sid, values)
+
+        self.stations = (t, snapshot)
+
+    def add_free_bikes(self, bdf):
+        """
+        Add a free_bike_status snapshot (as returned by query_free_bikes)
+        """
+        if bdf is None or len(bdf) == 0:
+            return
+
+        t = bdf['datetime'].iloc[0]
+        if self.bikes is not None and t <= self.bikes[0]:
+            return
+
+        bikes = set(bdf['bike_id'])
+        if self.bikes is not None:
+            t0, previous = self.bikes
+            counts = self.free_bike_trips.setdefault(t0.floor('h'), [0, 0])
+            counts[0] += len(previous - bikes)
+            counts[1] += len(bikes - previous)
+
+        self.free_bike_max = max(self.free_bike_max, len(bikes))
+        self.bikes = (t, bikes)
+
+    def hourly_trips(self):
+        """
+        Trips accumulated since the last reset, in the format of make_station_trips/make_free_bike_trips
+        """
+        rows = [{'datetime':hour, 'station_id':sid, 'trips':trips, 'returns':returns,
+                 'num_bikes_available':self.station_max[sid][0], 'num_docks_available':self.station_max[sid][1]}
+                for (hour, sid), (trips, returns) in self.station_trips.items()]
+        rows += [{'datetime':hour, 'station_id':'free_bikes', 'trips':trips, 'returns':returns,
+                  'num_bikes_available':self.free_bike_max, 'num_docks_available':None}
+                 for hour, (trips, returns) in self.free_bike_trips.items()]
+
+        return pd.DataFrame(rows, columns=['datetime','station_id','trips','returns','num_bikes_available','num_docks_available'])
+
+    def reset(self):
+        """
+        Clear accumulated trips once they're saved. The last snapshots are kept to bridge to the next ones.
+        """
+        self.station_trips = {}
+        self.station_max = {}
+        self.free_bike_trips = {}
+        self.free_bike_max = 0
+
+        if self.stations is not None:
+            for sid, values in self.stations[1].items():
+                self.station_trips[(self.stations[0].floor('h'), sid)] = [0, 0]
+                self._update_station_max(sid, values)
+        if self.bikes is not None:
+            self.free_bike_max = len(self.bikes[1])
+
+    def _update_station_max(self, sid, values):
+        m = self.station_max.setdefault(sid, [None, None])
+        for i, x in enumerate(values):
+            if x is not None and (m[i] is None or x > m[i]):
+                m[i] = x
+
+    def to_json(self):
+        state = {'stations':None, 'bikes':None,
+                 'station_trips':[[hour.isoformat(), sid, trips, returns] for (hour, sid), (trips, returns) in self.station_trips.items()],
+                 'station_max':self.station_max,
+                 'free_bike_trips':[[hour.isoformat(), trips, returns] for hour, (trips, returns) in self.free_bike_trips.items()],
+                 'free_bike_max':self.free_bike_max}
+        if self.stations is not None:
+            state['stations'] = [self.stations[0].isoformat(), self.stations[1]]
+        if self.bikes is not None:
+            state['bikes'] = [self.bikes[0].isoformat(), sorted(self.bikes[1])]
+        return json.dumps(state)
+
+    @classmethod
+    def from_json(cls, system_name, data):
+        state = json.loads(data)
+        acc = cls(system_name)
+        if state['stations'] is not None:
+            acc.stations = (pd.Timestamp(state['stations'][0]), {sid:tuple(x) for sid,x in state['stations'][1].items()})
+        if state['bikes'] is not None:
+            acc.bikes = (pd.Timestamp(state['bikes'][0]), set(state['bikes'][1]))
+        acc.station_trips = {(pd.Timestamp(hour), sid):[trips, returns] for hour, sid, trips, returns in state['station_trips']}
+        acc.station_max = state['station_max']
+        acc.free_bike_trips = {pd.Timestamp(hour):[trips, returns] for hour, trips, returns in state['free_bike_trips']}
+        acc.free_bike_max = state['free_bike_max']
+        return acc
+
+
+def _value(x):
+    return None if pd.isna(x) else int(x)
+
+
+## Checkpoints are kept in the raw db so a restarted tracker continues from the last snapshots.
+## They hold every bike id of the last free_bike_status snapshot, so they're saved on flush and when
+## the tracker stops rather than after every poll. Changes between the last checkpoint and a restart
+## are counted from the checkpoint's snapshots.
+
+def save_checkpoints(engine_raw, accumulators):
+    with engine_raw.begin() as conn:
+        conn.execute("create table if not exists trip_checkpoint (system text primary key, datetime timestamp, data text)")
+        for name, acc in accumulators.items():
+            conn.execute(text("insert or replace into trip_checkpoint values (:system, :datetime, :data)"),
+                         system=name, datetime=dt.datetime.utcnow(), data=acc.to_json())
+
+def drop_checkpoint(engine_raw, system_name):
+    try:
+        with engine_raw.begin() as conn:
+            conn.execute(text("delete from trip_checkpoint where system = :system"), system=system_name)
+    except OperationalError:
+        pass  # no checkpoints yet
+
+def load_checkpoints(engine_raw, system_names):
+    """
+    Returns {system name: TripAccumulator} for each system, restored from its checkpoint if there is one
+    """
+    accumulators = {name:TripAccumulator(name) for name in system_names}
+    try:
+        rows = engine_raw.execute("select system, datetime, data from trip_checkpoint").fetchall()
+    except OperationalError:
+        return accumulators
+
+    for name, t, data in rows:
+        if name in accumulators:
+            logger.info(f"{name} restoring trips from checkpoint of {t}")
+            accumulators[name] = TripAccumulator.from_json(name, data)
+    return accumulators
@@ -0,0 +1,80 @@
+import datetime as dt
+from functools import lru_cache
+
+import numpy as np
+import pytz
+
+
+# numpy units of the local time periods of each frequency, 't' is a single period
+PERIOD_UNITS = {'h':'h', 'd':'D', 'm':'M', 'y':'Y'}
+
+
+@lru_cache(maxsize=None)
+def get_tz(tz):
+    """
+    pytz.timezone, looked up once per name
+    """
+    return pytz.timezone(tz)
+
+@lru_cache(maxsize=None)
+def transitions(tz):
+    """
+    Table of the UTC offsets of a timezone, built once per System.tz:
+    (UTC datetime64 start of each offset, offset as timedelta64[s], pytz tzinfo in effect)
+    pytz keeps the transitions of each timezone, static timezones have a single entry.
+    """
+    tzinfo = get_tz(tz)
+    starts = getattr(tzinfo, '_utc_transition_times', None)
+    if not starts:
+        starts, tzinfos = [dt.datetime(1,1,1)], [tzinfo]
+        offsets = [tzinfo.utcoffset(dt.datetime(2000,1,1))]
+    else:
+        tzinfos = [tzinfo._tzinfos[info] for info in tzinfo._transition_info]
+        offsets = [utcoffset for utcoffset, dst, name in tzinfo._transition_info]
+
+    offsets = [int(x.total_seconds()) for x in offsets]
+    return (np.array(starts, dtype='datetime64[us]'), np.array(offsets, dtype='timedelta64[s]'),
+            np.array(tzinfos, dtype=object))
+
+def to_local_times(t, tz):
+    """
+    Vectorized to_local_time for a datetime64 array of UTC times.
+    Returns naive local datetime64 values and the pytz tzinfo in effect for each value.
+    """
+    starts, offsets, tzinfos = transitions(tz)
+    t = t.astype('datetime64[us]')
+    i = np.searchsorted(starts, t, side='right') - 1
+    return t + offsets[i], tzinfos[i]
+
+def utc_offsets(t1, t2, tz):
+    """
+    UTC offsets of tz over the UTC time range [t1, t2)
+    Returns a list of (UTC datetime, offset) for the start of the range and each time the offset changes
+    """
+    starts, offsets, _ = transitions(tz)
+    naive = lambda t: np.datetime64(t.replace(tzinfo=None), 'us')
+    first = np.searchsorted(starts, naive(t1), side='right') - 1
+    last = np.searchsorted(starts, naive(t2), side='left')
+
+    offset = lambda i: dt.timedelta(seconds=int(offsets[i].astype(np.int64)))
+    res = [(t1, offset(first))]
+    res += [(starts[i].item().replace(tzinfo=t1.tzinfo), offset(i)) for i in range(first + 1, last)]
+    return res
+
+def local_periods(local, frequency):
+    """
+    Integer period of each naive local datetime64. Grouping on these rather than on
+    aware datetimes keeps both hours that repeat at the end of DST in the same period.
+    """
+    if frequency == 't':
+        return np.zeros(len(local), dtype=np.int64)
+    return local.astype(f"datetime64[{PERIOD_UNITS.get(frequency,'h')}]").astype(np.int64)
+
+def trim_datetimes(local, frequency):
+    """
+    Vectorized trim_datetime for naive local datetime64 values
+    """
+    if frequency not in PERIOD_UNITS:
+        return local
+    start = local.astype(f"datetime64[{PERIOD_UNITS[frequency]}]").astype('datetime64[us]')
+    return start + (local - local.astype('datetime64[h]'))  # keep minutes for half-hour UTC offsets
@@ -4,10 +4,14 @@ import sys
 import json
 import datetime as dt
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 from bikeraccoonAPI import Measurement, System, Station, Trip, Base
+from bikeraccoonAPI.db_functions import rebuild_rollups, migrate_indexes, explain_query_plan
+from bikeraccoonAPI.api_functions import endpoint_queries
+from bikeraccoonAPI.lease_functions import lease_status
+from bikeraccoonAPI.archive_functions import archive_measurements, archive_status
+from bikeraccoonAPI.engine_functions import make_engine
 
 
 def load_system_interactive():
@@ -65,6 +69,36 @@ def add_system(system,session):
     
     session.commit()
     
+    
+def print_leases(session):
+    
+    workers, leases = lease_status(session)
+    
+    print(f"{'worker':<32} {'systems':>7}  {'started':<19}  {'heartbeat':<19}  status")
+    for w in workers:
+        print(f"{w['worker']:<32} {w['systems']:>7}  {w['started']:%Y-%m-%d %H:%M:%S}  {w['heartbeat']:%Y-%m-%d %H:%M:%S}  "
+              f"{'alive' if w['alive'] else 'dead'}")
+    
+    print(f"\n{'system':<32} {'worker':<32} {'since':<19}  {'expires':<19}")
+    for l in leases:
+        if l['worker'] is None:
+            print(f"{l['system']:<32} {'(unclaimed)':<32}")
+            continue
+        expired = '' if l['alive'] else '  expired'
+        print(f"{l['system']:<32} {l['worker']:<32} {l['acquired']:%Y-%m-%d %H:%M:%S}  {l['expires']:%Y-%m-%d %H:%M:%S}{expired}")
+    
+    
+def query_plans(session, system):
+    return {name:explain_query_plan(session, qry) for name, qry in endpoint_queries(session, system).items()}
+
+def print_query_plans(before, after):
+    for name in before:
+        print(f"\n{name}")
+        for label, plan in [('before', before[name]), ('after', after[name])]:
+            print(f"  {label}:")
+            for line in plan:
+                print(f"    {line}")
+    
 
 if __name__ == '__main__':
     
@@ -80,18 +114,31 @@ if __name__ == '__main__':
                       help="Activate a deactivated system")
     group.add_argument("--deactivate", action="store_true",
                       help="Deactivate an active system")
+    group.add_argument("--rollup", action="store_true",
+                      help="Rebuild daily/monthly/yearly rollups from hourly data (all systems unless -s is given)")
+    group.add_argument("--migrate", action="store_true",
+                      help="Upgrade an existing database: merge duplicate stations and measurements, add new tables and indexes "
+                           "and show the query plans of the API endpoints before and after (for -s or the first system)")
+    group.add_argument("--leases", action="store_true",
+                      help="Show which tracker worker holds each system (times are UTC)")
+    group.add_argument("--archive", action="store_true",
+                      help="Move measurements of closed months to Parquet files in --archive-dir (all systems unless -s is given)")
     parser.add_argument("-d", "--database", type=str,
                     help="specify path to database", default='bikeraccoon.db')
     parser.add_argument("-f", "--file", type=str,
                     help="file with system information", default=None)
     parser.add_argument("-s", "--system", type=str,
                     help="system name")
+    parser.add_argument("--archive-dir", type=str,
+                    help="directory of archived measurements", default='archive')
+    parser.add_argument("--keep-months", type=int,
+                    help="full months of measurements to keep in the database when archiving", default=1)
 
 
     args = parser.parse_args()
     
     # Connect to DB
-    engine = create_engine(f"sqlite:///{args.database}")
+    engine = make_engine(f"sqlite:///{args.database}")
     session = Session(engine)
     
     
@@ -129,4 +176,53 @@ if __name__ == '__main__':
         sys_obj.is_tracking = False
         session.add(sys_obj)
         session.commit()
-        
\ No newline at end of file
+            
+    elif args.rollup:
+        
+        Base.metadata.create_all(engine)  # Create rollup tables in databases that predate them
+        
+        qry = session.query(System)
+        if args.system is not None:
+            qry = qry.filter_by(name=args.system)
+        
+        for sys_obj in qry.all():
+            print(f"Rebuilding rollups for {sys_obj.name}")
+            rebuild_rollups(sys_obj, session)
+            
+    elif args.migrate:
+        
+        Base.metadata.create_all(engine)  # New tables
+        
+        qry = session.query(System).order_by(System.name)
+        if args.system is not None:
+            qry = qry.filter_by(name=args.system)
+        system = qry.first()
+        
+        before = query_plans(session, system) if system is not None else {}
+        added, dropped = migrate_indexes(session, analyze=True)
+        print(f"added indexes: {', '.join(added) or 'none'}")
+        print(f"dropped indexes: {', '.join(dropped) or 'none'}")
+        if system is not None:
+            print_query_plans(before, query_plans(session, system))
+        
+    elif args.leases:
+        
+        Base.metadata.create_all(engine)  # Lease tables in databases that predate them
+        print_leases(session)
+        
+    elif args.archive:
+        
+        Base.metadata.create_all(engine)  # Archive table in databases that predate it
+        migrate_indexes(session)  # Merge duplicate stations first
+        
+        qry = session.query(System)
+        if args.system is not None:
+            qry = qry.filter_by(name=args.system)
+        
+        for sys_obj in qry.all():
+            months = archive_measurements(sys_obj, session, args.archive_dir, args.keep_months)
+            print(f"{sys_obj.name}: archived {len(months)} months")
+        
+        print(f"\n{'system':<32} {'months':>6}  {'rows':>10}  {'first':<7}  {'last':<7}")
+        for x in archive_status(session):
+            print(f"{x['system']:<32} {x['months']:>6}  {x['rows']:>10}  {x['first']:%Y-%m}  {x['last']:%Y-%m}")
@@ -15,6 +15,7 @@ setup(name='bikeraccoonAPI',
         'twitterer @  https://api.github.com/repos/mjarrett/twitterer/tarball/',
         'Flask==1.1.2',
         'Flask-Cors==3.0.10',
+        'numpy==1.19.5',
         'oauthlib==3.1.0',
         'pandas==1.2.1',
         'psutil==5.8.0',
@@ -22,8 +23,12 @@ setup(name='bikeraccoonAPI',
         'requests==2.25.1',
         'requests-oauthlib==1.3.0',
         'SQLAlchemy==1.3.22',
-        'timeout-decorator==0.5.0',
         'tweepy==3.10.0',
         'urllib3==1.26.3',
-      ]
+      ],
+      extras_require = {
+        'compression': ['brotli==1.2.0'],  # brotli encoded API responses
+        'formats': ['pyarrow==12.0.1', 'msgpack==1.1.1'],  # parquet, arrow and msgpack API responses
+        'archive': ['pyarrow==12.0.1'],  # archived measurements, see archive_functions.py
+      }
      )